@@ -6,7 +6,12 @@ from slicer.ScriptedLoadableModule import *
 import logging
 import sitkUtils
 import numpy as np
-from subprocess import check_output
+import binascii
+import collections
+import shutil
+import subprocess
+import tempfile
+from multiprocessing.connection import Client
 
 #
 # selector
@@ -123,6 +128,62 @@ class selectorWidget(ScriptedLoadableModuleWidget):
                                                   while a positive value will expand the contour in these areas.""")
     parametersFormLayout.addRow("Baloon (GAC only)", self.enableBaloonFlagCheckBox)
 
+    #
+    # region of interest
+    #
+    self.roiCheckBox = qt.QCheckBox()
+    self.roiCheckBox.checked = 1
+    self.roiCheckBox.setToolTip("""Only process a box around the seed, growing it while the contour reaches
+                                     its border, instead of the whole volume.""")
+    parametersFormLayout.addRow("Crop to seed", self.roiCheckBox)
+
+    #
+    # multi-resolution
+    #
+    self.pyramidCheckBox = qt.QCheckBox()
+    self.pyramidCheckBox.checked = 0
+    self.pyramidCheckBox.setToolTip("""Evolve the 3D snakes on a downsampled volume first and only refine the
+                                     result at full resolution, showing the coarse result meanwhile. Small
+                                     objects are downsampled less, or not at all.""")
+    parametersFormLayout.addRow("Coarse to fine (3D only)", self.pyramidCheckBox)
+
+    #
+    # live preview
+    #
+    self.liveCheckBox = qt.QCheckBox()
+    self.liveCheckBox.checked = 1
+    self.liveCheckBox.setToolTip("""Show the contour while it evolves, so a run leaking out of the object can be
+                                     cancelled early.""")
+    parametersFormLayout.addRow("Live preview", self.liveCheckBox)
+
+    #
+    # resume
+    #
+    self.resumeCheckBox = qt.QCheckBox()
+    self.resumeCheckBox.checked = 1
+    self.resumeCheckBox.setToolTip("""Continue from the result of the same seed and mode when only the iterations
+                                     were raised or the smoothing changed, instead of starting over.""")
+    parametersFormLayout.addRow("Resume earlier run", self.resumeCheckBox)
+
+    #
+    # segment to start from
+    #
+    self.initSegmentSelector = slicer.qMRMLSegmentSelectorWidget()
+    self.initSegmentSelector.setMRMLScene(slicer.mrmlScene)
+    self.initSegmentSelector.noneEnabled = True
+    self.initSegmentSelector.setToolTip("""Start the contour of a single seed from this segment instead of a ball
+                                     around the seed.""")
+    parametersFormLayout.addRow("Start from segment", self.initSegmentSelector)
+
+    #
+    # every fiducial
+    #
+    self.allSeedsCheckBox = qt.QCheckBox()
+    self.allSeedsCheckBox.checked = 0
+    self.allSeedsCheckBox.setToolTip("""Segment the object around every placed fiducial in a single run, each in a
+                                     segment of its own, instead of only around the last one.""")
+    parametersFormLayout.addRow("Every fiducial", self.allSeedsCheckBox)
+
 
     self.markupsNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLMarkupsFiducialNode")
 
@@ -197,12 +258,82 @@ class selectorWidget(ScriptedLoadableModuleWidget):
     self.gac2d.connect('clicked(bool)', self.onGac2d)
     parametersFormLayout.addRow(self.gac2d)
 
+    #
+    # Progress of the running segmentation
+    #
+    self.progressBar = qt.QProgressBar()
+    self.progressBar.minimum = 0
+    self.progressBar.maximum = 100
+    self.progressBar.value = 0
+    parametersFormLayout.addRow("Progress", self.progressBar)
+
+    self.statusLabel = qt.QLabel()
+    parametersFormLayout.addRow(self.statusLabel)
+
+    #
+    # Cancel Buttons
+    #
+    self.cancelButton = qt.QPushButton("Cancel")
+    self.cancelButton.toolTip = "Stop the running segmentation."
+    self.cancelButton.enabled = False
+    self.cancelButton.connect('clicked(bool)', self.onCancel)
+    self.cancelAllButton = qt.QPushButton("Cancel all")
+    self.cancelAllButton.toolTip = "Stop the running segmentation and drop the queued ones."
+    self.cancelAllButton.enabled = False
+    self.cancelAllButton.connect('clicked(bool)', self.onCancelAll)
+    cancelLayout = qt.QHBoxLayout()
+    cancelLayout.addWidget(self.cancelButton)
+    cancelLayout.addWidget(self.cancelAllButton)
+    parametersFormLayout.addRow(cancelLayout)
+
+    #
+    # Parameter sweep Area
+    #
+    sweepCollapsibleButton = ctk.ctkCollapsibleButton()
+    sweepCollapsibleButton.text = "Parameter sweep"
+    sweepCollapsibleButton.collapsed = True
+    self.layout.addWidget(sweepCollapsibleButton)
+    sweepFormLayout = qt.QFormLayout(sweepCollapsibleButton)
+
+    self.sweepModeComboBox = qt.QComboBox()
+    self.sweepModeComboBox.addItems(["3D - MorphACWE", "2D - MorphACWE", "3D - MorphGAC", "2D - MorphGAC",
+                                     "2D - MorphACWE (prev)"])
+    sweepFormLayout.addRow("Mode", self.sweepModeComboBox)
+
+    # Comma separated values, the parameters above when empty
+    self.sweepIterationsEdit = qt.QLineEdit()
+    self.sweepIterationsEdit.placeholderText = "e.g. 20, 40, 80"
+    sweepFormLayout.addRow("Iterations", self.sweepIterationsEdit)
+    self.sweepSmoothingEdit = qt.QLineEdit()
+    self.sweepSmoothingEdit.placeholderText = "e.g. 1, 2"
+    sweepFormLayout.addRow("Smoothing", self.sweepSmoothingEdit)
+    self.sweepThresholdEdit = qt.QLineEdit()
+    self.sweepThresholdEdit.placeholderText = "e.g. 0.3, 0.5 (GAC only)"
+    sweepFormLayout.addRow("Threshold", self.sweepThresholdEdit)
+    self.sweepBalloonEdit = qt.QLineEdit()
+    self.sweepBalloonEdit.placeholderText = "e.g. 1, -1 (GAC only)"
+    sweepFormLayout.addRow("Baloon", self.sweepBalloonEdit)
+
+    self.sweepButton = qt.QPushButton("Sweep")
+    self.sweepButton.toolTip = """Segment around the seed with every combination of the values above, each in a
+                                   segment of its own, to compare them side by side."""
+    self.sweepButton.connect('clicked(bool)', self.onSweepButton)
+    sweepFormLayout.addRow(self.sweepButton)
+
 
     # Add vertical spacer
     self.layout.addStretch(1)
 
     self.ras = [0, 0, 0]
 
+    # The segmentations run one after another in the background, so the
+    # buttons queue new ones meanwhile
+    self.logic = selectorLogic()
+    self.jobQueue = SnakeJobQueue()
+    self.jobQueue.onChanged = self.updateStatus
+    self.progressJob = None
+    self.updateStatus()
+
   def placementModeChanged(self, active):
     if active == False:
       slicer.mrmlScene.Redo()
@@ -210,7 +341,33 @@ class selectorWidget(ScriptedLoadableModuleWidget):
       slicer.util.getNode('Crosshair').GetCursorPositionRAS(self.ras)
 
   def cleanup(self):
-    pass
+    self.jobQueue.cancelAll()
+    stopSnakeWorker()
+
+  def onCancel(self):
+    if self.jobQueue.current is not None:
+      self.jobQueue.cancel(self.jobQueue.current)
+
+  def onCancelAll(self):
+    self.jobQueue.cancelAll()
+
+  def onProgress(self, fraction):
+    self.progressBar.value = int(round(100 * fraction))
+
+  def updateStatus(self):
+    running = self.jobQueue.current is not None
+    pending = self.jobQueue.pending()
+    if self.jobQueue.current is not self.progressJob:
+      self.progressJob = self.jobQueue.current
+      self.progressBar.value = 0
+    if not running:
+      self.statusLabel.text = "Idle"
+    elif pending:
+      self.statusLabel.text = "Running, %d queued" % pending
+    else:
+      self.statusLabel.text = "Running"
+    self.cancelButton.enabled = running
+    self.cancelAllButton.enabled = running or pending > 0
 
   def onAcwe3d(self):
     self.onApplyButton(0)
@@ -234,20 +391,426 @@ class selectorWidget(ScriptedLoadableModuleWidget):
       self.color[2] = color.blue()
 
   def onApplyButton(self, mode):
-    logic = selectorLogic()
     enableBaloonFlag = self.enableBaloonFlagCheckBox.checked
     iterations = self.iterationsSliderWidget.value
     smoothing = self.smoothingSliderWidget.value
     threshold = self.thresholdSliderWidget.value
+    roi = self.roiCheckBox.checked
+    pyramid = self.pyramidCheckBox.checked
+    live = self.liveCheckBox.checked
+    resume = self.resumeCheckBox.checked
+    initSegment = None
+    if self.initSegmentSelector.currentNode() is not None and self.initSegmentSelector.currentSegmentID():
+      initSegment = (self.initSegmentSelector.currentNode(), self.initSegmentSelector.currentSegmentID())
     volume = self.inputSelector.currentNode()
     
     name = self.textWidget.toPlainText()
     numFids = self.markupsNode.GetNumberOfFiducials()
+    seeds = self.ras
+    if self.allSeedsCheckBox.checked and numFids > 0:
+      seeds = []
+      for i in range(numFids):
+        point = [0, 0, 0]
+        self.markupsNode.GetNthFiducialPosition(i, point)
+        seeds.append(point)
     for i in range(numFids):
         self.markupsNode.SetNthFiducialVisibility(i, 0)
 
-    logic.run(mode, volume, self.ras, enableBaloonFlag,
-              iterations, smoothing, threshold, self.color, name)
+    # The color is copied, as the picker changes it in place
+    self.logic.submit(self.jobQueue, mode, volume, seeds, enableBaloonFlag,
+                      iterations, smoothing, threshold, list(self.color), name, roi, pyramid, live,
+                      resume, initSegment, onProgress=self.onProgress)
+
+
+  def sweepValues(self, lineEdit, default):
+    """Comma separated numbers of lineEdit, or default when it is empty."""
+    text = lineEdit.text.strip()
+    if not text:
+      return [default]
+    return [float(value) for value in text.split(',') if value.strip()]
+
+  def onSweepButton(self):
+    try:
+      grid = {
+          'iterations': self.sweepValues(self.sweepIterationsEdit, self.iterationsSliderWidget.value),
+          'smoothing': self.sweepValues(self.sweepSmoothingEdit, self.smoothingSliderWidget.value),
+          'threshold': self.sweepValues(self.sweepThresholdEdit, self.thresholdSliderWidget.value),
+          'balloon': self.sweepValues(self.sweepBalloonEdit, 1 if self.enableBaloonFlagCheckBox.checked else -1)}
+    except ValueError:
+      slicer.util.errorDisplay("The sweep values must be numbers separated by commas.")
+      return
+
+    self.logic.submitSweep(self.jobQueue, self.sweepModeComboBox.currentIndex, self.inputSelector.currentNode(),
+                           self.ras, grid, self.textWidget.toPlainText(), self.roiCheckBox.checked,
+                           self.pyramidCheckBox.checked, onProgress=self.onProgress)
+
+
+#
+# SnakeWorker
+#
+
+class SnakeWorker(object):
+  """Long-lived python3 process running utils/worker.py.
+
+  numpy and scipy stay imported between runs, so a segmentation only costs its
+  own computation. The worker is health-checked before every request and
+  restarted if it died or stopped answering.
+  """
+
+  PYTHON = "/usr/bin/python3"
+  PING_TIMEOUT = 5.0
+  # Messages the worker sends about a request before its reply
+  UPDATES = ('preview', 'progress', 'live')
+
+  def __init__(self):
+    self.process = None
+    self.connection = None
+
+  def start(self):
+    dir_path = os.path.dirname(os.path.realpath(__file__))
+    authkey = binascii.hexlify(os.urandom(16))
+    env = slicer.util.startupEnvironment()
+    env['SELECTOR_WORKER_AUTHKEY'] = authkey.decode()
+    self.process = subprocess.Popen(
+        [self.PYTHON, dir_path + "/utils/worker.py"],
+        cwd=dir_path + "/utils", env=env, stdout=subprocess.PIPE)
+    port = int(self.process.stdout.readline())
+    self.connection = Client(('localhost', port), authkey=authkey)
+    logging.info('Snake worker started (pid %d)' % self.process.pid)
+
+  def stop(self):
+    if self.connection is not None:
+      self.connection.close()
+      self.connection = None
+    if self.process is not None:
+      if self.process.poll() is None:
+        self.process.kill()
+      self.process.wait()
+      self.process = None
+
+  def isAlive(self):
+    if self.process is None or self.process.poll() is not None:
+      return False
+    try:
+      self.connection.send({'command': 'ping'})
+      if not self.connection.poll(self.PING_TIMEOUT):
+        return False
+      return self.connection.recv()['status'] == 'ok'
+    except (EOFError, OSError):
+      return False
+
+  def send(self, message):
+    """Send a request to the worker, (re)starting it if needed. Its replies
+    are read with receive."""
+    if not self.isAlive():
+      self.stop()
+      self.start()
+    try:
+      self.connection.send(message)
+    except (EOFError, OSError):
+      self.stop()
+      raise RuntimeError('The snake worker died while receiving the request')
+
+  def receive(self, timeout=None):
+    """Return the next message of the worker about the current request, or
+    None if it sent none within timeout seconds (None waits for ever).
+
+    Preview, progress and live messages are returned as they are; for the final
+    reply the log of the run is printed and a RuntimeError is raised if the
+    request failed.
+    """
+    try:
+      if timeout is not None and not self.connection.poll(timeout):
+        return None
+      reply = self.connection.recv()
+    except (EOFError, OSError):
+      self.stop()
+      raise RuntimeError('The snake worker died while processing the request')
+    if reply['status'] in self.UPDATES:
+      return reply
+    if reply['log']:
+      print(reply['log'])
+    if reply['status'] == 'error':
+      raise RuntimeError(reply['message'])
+    return reply
+
+  def request(self, message, onUpdate=None):
+    """Send a request to the worker and wait for its reply. The preview,
+    progress and live messages sent before the reply are passed to
+    onUpdate."""
+    self.send(message)
+    reply = self.receive()
+    while reply['status'] in self.UPDATES:
+      if onUpdate is not None:
+        onUpdate(reply)
+      reply = self.receive()
+    return reply
+
+
+_snakeWorker = None
+
+def snakeWorker():
+  """Worker shared by all the runs, started on first use."""
+  global _snakeWorker
+  if _snakeWorker is None:
+    _snakeWorker = SnakeWorker()
+  return _snakeWorker
+
+def stopSnakeWorker():
+  global _snakeWorker
+  if _snakeWorker is not None:
+    _snakeWorker.stop()
+    _snakeWorker = None
+
+
+#
+# Results of the worker
+#
+
+def unpackResult(result):
+  """Decode the compact result of the worker, from snake.compact_mask, and
+  return the array of the volume in its box and the box, as a tuple of slices
+  into the volume array, at a cost that follows the size of the object."""
+  box = tuple(slice(start, stop) for start, stop in result['box'])
+  shape = tuple(s.stop - s.start for s in box)
+  data = np.frombuffer(result['data'], dtype=np.uint8)
+  if result['packed']:
+    data = np.unpackbits(data, count=int(np.prod(shape)))
+  else:
+    # VTK may write to the arrays it is given
+    data = data.copy()
+  return data.reshape(shape), box
+
+
+def expandResult(result):
+  """Decode the compact result of the worker into an array with the shape
+  of the whole volume."""
+  crop, box = unpackResult(result)
+  array = np.zeros(result['shape'], dtype=np.uint8)
+  array[box] = crop
+  return array
+
+
+#
+# SnakeJob
+#
+
+class SnakeJob(object):
+  """Segmentation request for the snake worker, with the data it works on.
+
+  The volume is copied at creation into a memory-mapped file in a directory of
+  the job, so the worker maps it directly, nothing is serialised, and the
+  volume can change or other jobs be queued meanwhile without touching this
+  one's data. The worker sends the mask back in the compact form of
+  snake.compact_mask, kept in result: unpackResult gives the box of the
+  object and its voxels, and mask the whole volume, decoded on first use.
+  The job goes from 'queued' to 'running' and ends 'done', 'failed' or
+  'cancelled'; its directory is removed when it ends.
+
+  onPreview is called with the intermediate masks the worker sends,
+  onProgress with the estimated fraction of the job that is done, and
+  onFinished with the job once it ended. onLive is called with the mask as
+  the snake evolves: the worker streams the voxels that changed at most every
+  LIVE_INTERVAL ms, which are applied to a mask kept here, and onLive gets it
+  on refresh if it changed since the last time. init, if given, is the level
+  set the snake starts from, copied next to the volume.
+  """
+
+  # Job data lives in RAM-backed storage when the system has it
+  JOB_DIR_ROOT = '/dev/shm' if os.path.isdir('/dev/shm') else None
+  LIVE_INTERVAL = 250  # ms
+
+  def __init__(self, data, message, onPreview=None, onProgress=None, onFinished=None, onLive=None,
+               init=None):
+    self.onPreview = onPreview
+    self.onProgress = onProgress
+    self.onFinished = onFinished
+    self.onLive = onLive
+    self.state = 'queued'
+    self.result = None
+    self.expanded = None
+    self.reply = None
+    self.error = None
+    self.shape = data.shape
+    self.liveMask = None
+    self.liveChanged = False
+
+    self.jobDir = tempfile.mkdtemp(prefix='selector-', dir=self.JOB_DIR_ROOT)
+    try:
+      self.imagePath = os.path.join(self.jobDir, 'image.npy')
+      image = np.lib.format.open_memmap(self.imagePath, mode='w+', dtype=data.dtype, shape=data.shape)
+      image[...] = data
+      del image
+      initPath = None
+      if init is not None:
+        initPath = os.path.join(self.jobDir, 'init.npy')
+        np.save(initPath, np.asarray(init, dtype=np.uint8))
+    except Exception:
+      self.cleanup()
+      raise
+
+    self.message = dict(message, image=self.imagePath, out=None, init=initPath,
+                        preview=onPreview is not None, progress=onProgress is not None,
+                        live=self.LIVE_INTERVAL if onLive is not None else 0)
+
+  def update(self, reply):
+    """Handle a preview, progress or live message of the worker."""
+    if reply['status'] == 'preview' and self.onPreview is not None:
+      self.onPreview(np.load(reply['mask'], mmap_mode='r'))
+    elif reply['status'] == 'progress' and self.onProgress is not None:
+      self.onProgress(reply['fraction'])
+    elif reply['status'] == 'live' and self.onLive is not None:
+      if self.liveMask is None:
+        self.liveMask = np.zeros(self.shape, dtype=np.uint8)
+      voxels = self.liveMask.reshape(-1)
+      voxels[reply['added']] = 1
+      voxels[reply['removed']] = 0
+      self.liveChanged = True
+
+  def refresh(self):
+    """Pass the live mask to onLive if it changed since the last call."""
+    if self.liveChanged:
+      self.liveChanged = False
+      self.onLive(self.liveMask)
+
+  def finish(self, state, reply=None, error=None):
+    self.state = state
+    self.reply = reply
+    self.error = error
+    self.liveMask = None
+    if state == 'done':
+      self.result = reply['result']
+    self.cleanup()
+    if self.onFinished is not None:
+      self.onFinished(self)
+
+  @property
+  def mask(self):
+    """Result of a done job with the shape of the volume, None otherwise."""
+    if self.expanded is None and self.result is not None:
+      self.expanded = expandResult(self.result)
+    return self.expanded
+
+  def cleanup(self):
+    shutil.rmtree(self.jobDir, ignore_errors=True)
+
+  def run(self, worker):
+    """Run the job in worker and wait for it to end. Failures are raised."""
+    # Nothing returns to the event loop meanwhile, so the updates are drawn
+    # right away
+    def update(reply):
+      self.update(reply)
+      self.refresh()
+      slicer.app.processEvents()
+
+    self.state = 'running'
+    try:
+      reply = worker.request(self.message, update)
+    except Exception as e:
+      self.finish('failed', error=str(e))
+      raise
+    self.finish('done', reply)
+
+
+#
+# SnakeJobQueue
+#
+
+class SnakeJobQueue(object):
+  """Runs SnakeJobs one after another in the snake worker without blocking
+  the GUI.
+
+  A job is sent to the worker when the previous one ended, and a timer polls
+  the worker for its messages from the event loop. Cancelling the running job
+  kills the worker, which is restarted for the next one; queued jobs are just
+  dropped. onChanged, if set, is called whenever a job starts or ends.
+  """
+
+  POLL_INTERVAL = 100  # ms
+
+  def __init__(self, worker=None):
+    self.worker = worker
+    self.jobs = collections.deque()
+    self.current = None
+    self.onChanged = None
+    self.timer = qt.QTimer()
+    self.timer.setInterval(self.POLL_INTERVAL)
+    self.timer.connect('timeout()', self.poll)
+
+  def getWorker(self):
+    return self.worker if self.worker is not None else snakeWorker()
+
+  def submit(self, job):
+    self.jobs.append(job)
+    self.startNext()
+    return job
+
+  def pending(self):
+    """Number of jobs waiting for the running one."""
+    return len(self.jobs)
+
+  def startNext(self):
+    while self.current is None and self.jobs:
+      job = self.jobs.popleft()
+      try:
+        self.getWorker().send(job.message)
+      except Exception as e:
+        logging.error('Could not start the segmentation: %s' % e)
+        job.finish('failed', error=str(e))
+        continue
+      job.state = 'running'
+      self.current = job
+      self.timer.start()
+    self.changed()
+
+  def poll(self):
+    job = self.current
+    if job is None:
+      self.timer.stop()
+      return
+    # Every message already sent is handled, without waiting for more, and
+    # the live mask is only shown once for all of them
+    worker = self.getWorker()
+    try:
+      reply = worker.receive(0)
+      while reply is not None and reply['status'] in worker.UPDATES:
+        job.update(reply)
+        reply = worker.receive(0)
+    except RuntimeError as e:
+      self.finish(job, 'failed', error=str(e))
+      return
+    if reply is not None:
+      self.finish(job, 'done', reply)
+    else:
+      job.refresh()
+
+  def finish(self, job, state, reply=None, error=None):
+    self.current = None
+    self.timer.stop()
+    try:
+      job.finish(state, reply, error)
+    finally:
+      self.startNext()
+
+  def cancel(self, job):
+    if job is self.current:
+      # The worker cannot be interrupted in the middle of a run
+      self.getWorker().stop()
+      self.finish(job, 'cancelled')
+    elif job in self.jobs:
+      self.jobs.remove(job)
+      job.finish('cancelled')
+      self.changed()
+
+  def cancelAll(self):
+    while self.jobs:
+      self.cancel(self.jobs[-1])
+    if self.current is not None:
+      self.cancel(self.current)
+
+  def changed(self):
+    if self.onChanged is not None:
+      self.onChanged()
 
 
 #
@@ -257,98 +820,303 @@ class selectorWidget(ScriptedLoadableModuleWidget):
 
 class selectorLogic(ScriptedLoadableModuleLogic):
 
-  def calc_coord(self, volumeNode, coord):
+  # Number of earlier results kept to resume from
+  RESUME_RESULTS = 8
+
+  def __init__(self, parent=None):
+    ScriptedLoadableModuleLogic.__init__(self, parent)
+    # Last result, in compact form, and its iterations for every volume,
+    # seeds, mode and parameters but the iterations and the smoothing
+    self.results = collections.OrderedDict()
+
+  def showMask(self, segmentationNode, volumeNode, mask, name, color, box=None):
+    """Replace the contents of segmentationNode by a single segment made from
+    mask, an array with the layout of the volume, or of its part box."""
+    self.showLabels(segmentationNode, volumeNode, mask, [name], color, box)
+
+  def labelmapFromArray(self, volumeNode, labels, name, box=None):
+    """New labelmap node filled from labels, an array with the layout of the
+    volume, or of its part box, a tuple of slices into the volume array."""
+    # The labels have the layout of the volume array, so a labelmap with the
+    # geometry of the volume, moved to the corner of the box, can be filled
+    # from them in one go
+    labelmapVolumeNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLLabelMapVolumeNode')
+    labelmapVolumeNode.SetName(name)
     volumeIjkToRas = vtk.vtkMatrix4x4()
     volumeNode.GetIJKToRASMatrix(volumeIjkToRas)
-    point_VolumeRas = [0, 0, 0, 1]
-    volumeIjkToRas.MultiplyPoint(np.append(coord, 1.0), point_VolumeRas)
-    point_VolumeRas.pop()
-    return point_VolumeRas
+    if box is not None:
+      # The array axes are k, j, i
+      corner = [0, 0, 0, 1]
+      volumeIjkToRas.MultiplyPoint([box[2].start, box[1].start, box[0].start, 1], corner)
+      for row in range(3):
+        volumeIjkToRas.SetElement(row, 3, corner[row])
+    labelmapVolumeNode.SetIJKToRASMatrix(volumeIjkToRas)
+    slicer.util.updateVolumeFromArray(labelmapVolumeNode, labels)
+    return labelmapVolumeNode
+
+  def showLabels(self, segmentationNode, volumeNode, labels, names, color, box=None):
+    """Replace the contents of segmentationNode by a segment for every label
+    of labels, an array with the layout of the volume, or of its part box.
+    names are the names of the labels that are present, in increasing
+    order."""
+    # All the segments are created in a single update of the node
+    wasModified = segmentationNode.StartModify()
+    segmentation = segmentationNode.GetSegmentation()
+    segmentation.RemoveAllSegments()
+    if labels.size > 0:
+      labelmapVolumeNode = self.labelmapFromArray(volumeNode, labels, names[0] if names else 'labels', box)
+      slicer.modules.segmentations.logic().ImportLabelmapToSegmentationNode(labelmapVolumeNode, segmentationNode)
+      slicer.mrmlScene.RemoveNode(labelmapVolumeNode)
+
+    for i in range(min(len(names), segmentation.GetNumberOfSegments())):
+      segment = segmentation.GetNthSegment(i)
+      segment.SetName(names[i])
+      segment.SetColor(color[0] / 255.0, color[1] / 255.0, color[2] / 255.0)
+    segmentationNode.CreateClosedSurfaceRepresentation()
+    segmentationNode.EndModify(wasModified)
 
-  def run(self, mode, volumeNode, ras, enableBaloonFlag, iterations, smoothing, threshold, color, name):
+  def seedCoords(self, volumeNode, seeds):
+    """Voxel coordinates of the RAS points seeds in volumeNode."""
+    volumeRasToIjk = vtk.vtkMatrix4x4()
+    volumeNode.GetRASToIJKMatrix(volumeRasToIjk)
+    coords = []
+    for seed in seeds:
+      point_Ijk = [0, 0, 0, 1]
+      volumeRasToIjk.MultiplyPoint(np.append(seed, 1.0), point_Ijk)
+      coords.append([ int(round(c)) for c in point_Ijk[0:3] ])
+    return coords
+
+  def createJob(self, mode, volumeNode, ras, enableBaloonFlag, iterations, smoothing, threshold, color, name,
+                roi=False, pyramid=False, live=False, resume=False, initSegment=None,
+                onProgress=None, onFinished=None):
     """
-    Run the actual algorithm
+    Create the job segmenting volumeNode around ras, which shows its result in
+    a new segmentation node when it is done
+
+    ras is the seed, or a list of seeds whose objects are segmented in a
+    single run of the worker, each in a segment of its own. With live, the
+    contour of a single seed is shown in a preview segment while it evolves.
+    With resume, a run that only differs from an earlier one by more
+    iterations or another smoothing continues from its result and only runs
+    the extra iterations. initSegment, a (segmentationNode, segmentId) pair,
+    starts a single seed from that segment instead of a ball. onProgress is
+    called with the estimated fraction of the job that is done, and
+    onFinished with the job once it ended, after its result is shown.
     """
     print(ras)
-    logging.info('Processing started')
 
-    dir_path = os.path.dirname(os.path.realpath(__file__))
     if enableBaloonFlag == True:
       ballon = 1
     else:
       ballon = -1
 
-    volumeRasToIjk = vtk.vtkMatrix4x4()
-    volumeNode.GetRASToIJKMatrix(volumeRasToIjk)
-    point_Ijk = [0, 0, 0, 1]
-    volumeRasToIjk.MultiplyPoint(np.append(ras, 1.0), point_Ijk)
-    point_Ijk = [ int(round(c)) for c in point_Ijk[0:3] ]
+    coords = self.seedCoords(volumeNode, [ras] if np.ndim(ras) == 1 else ras)
     # Print output
     data = slicer.util.arrayFromVolume(volumeNode)
-    np.save(dir_path + '/utils/image.npy', data)
-    np.save(dir_path + '/utils/coord.npy', point_Ijk)
-
-    print('Snake')
-    command_line = ["/usr/bin/python3",
-                    dir_path + "/utils/snake.py",
-                    str(int(mode)),
-                    str(int(float(iterations))),
-                    str(int(float(smoothing))),
-                    str(threshold),
-                    str(ballon)]
-    command_result = check_output(
-        command_line, env=slicer.util.startupEnvironment())
-    print(command_result)
-
-    
-    data = np.load(dir_path + '/utils/out.npy')
-    coord = np.load(dir_path + '/utils/coord.npy')
-    new_data = []
-
-    for i, val_i in enumerate(data):
-      for j, val_j in enumerate(data[i]):
-        line_started = False
-        line = vtk.vtkLineSource()
-        for k, val_k in enumerate(data[i][j]):
-          if val_k != 0 and line_started == False:
-            line_started = True
-            line.SetPoint1(self.calc_coord(volumeNode, [k, j, i]))
-            line.Update()
-          if val_k == 0 and line_started == True:
-            line.SetPoint2(self.calc_coord(volumeNode, [k - 1, j, i]))
-            line.Update()
-            new_data.append(line)
-            line_started = False
-            line = vtk.vtkLineSource()
+    iterations = int(float(iterations))
 
+    # A coarse to fine run is cheaper to run again than to resume at full
+    # resolution
+    key = (volumeNode.GetID(), volumeNode.GetImageData().GetMTime(), np.ndim(ras),
+           tuple(tuple(c) for c in coords), int(mode), float(threshold), ballon, bool(roi), bool(pyramid))
+    init = None
+    done = 0
+    if initSegment is not None:
+      if np.ndim(ras) == 1:
+        init = slicer.util.arrayFromSegmentBinaryLabelmap(initSegment[0], initSegment[1], volumeNode)
+      else:
+        logging.warning('A segment to start from is only used with a single seed')
+    elif resume and not pyramid and key in self.results:
+      previous, previousIterations = self.results[key]
+      if previousIterations < iterations:
+        init, done = expandResult(previous), previousIterations
+        print('Resuming after %d iterations' % done)
 
     segmentationNode = slicer.vtkMRMLSegmentationNode()
     slicer.mrmlScene.AddNode(segmentationNode)
     segmentationNode.CreateDefaultDisplayNodes()
     segmentationNode.SetReferenceImageGeometryParameterFromVolumeNode(volumeNode)
-    append = vtk.vtkAppendPolyData()
-    for line in new_data:
-      append.AddInputData(line.GetOutput())
 
-    append.Update()
+    # The coarse results of the pyramid are shown while the rest runs
+    def showPreview(mask):
+      self.showMask(segmentationNode, volumeNode, mask, name, color)
 
-    red = color[0] / 255.0
-    green = color[1] / 255.0
-    blue = color[2] / 255.0
-    tempSegment = segmentationNode.AddSegmentFromClosedSurfaceRepresentation(append.GetOutput(), "Temp", [red, green, blue])
+    # The evolving contour updates a single segment in place, without the
+    # import and the surface of a complete result
+    liveSegmentId = []
+    def showLive(mask):
+      segmentation = segmentationNode.GetSegmentation()
+      if not liveSegmentId or segmentation.GetSegment(liveSegmentId[0]) is None:
+        segmentation.RemoveAllSegments()
+        liveSegmentId[:] = [segmentation.AddEmptySegment(
+            '', name + ' (preview)', [color[0] / 255.0, color[1] / 255.0, color[2] / 255.0])]
+      slicer.util.updateSegmentBinaryLabelmapFromArray(mask, segmentationNode, liveSegmentId[0], volumeNode)
 
-    labelmapVolumeNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLLabelMapVolumeNode')
-    slicer.modules.segmentations.logic().ExportAllSegmentsToLabelmapNode(segmentationNode, labelmapVolumeNode)
+    def finished(job):
+      if job.state == 'done':
+        self.results[key] = (job.result, iterations)
+        self.results.move_to_end(key)
+        while len(self.results) > self.RESUME_RESULTS:
+          self.results.popitem(last=False)
+        if 'counts' in job.reply:
+          names = []
+          for i, count in enumerate(job.reply['counts']):
+            if count > 0:
+              names.append('%s %d' % (name, i + 1))
+            else:
+              logging.warning('Nothing was segmented around seed %d' % (i + 1))
+          labels, box = unpackResult(job.result)
+          self.showLabels(segmentationNode, volumeNode, labels, names, color, box)
+        else:
+          mask, box = unpackResult(job.result)
+          self.showMask(segmentationNode, volumeNode, mask, name, color, box)
+        print('Zrobione')
+      else:
+        # Previews of a job that did not end are not kept
+        slicer.mrmlScene.RemoveNode(segmentationNode)
+        if job.state == 'failed':
+          logging.error('Segmentation failed: %s' % job.error)
+      if onFinished is not None:
+        onFinished(job)
 
-    labelmapVolumeNode.SetName(name)
-    slicer.modules.segmentations.logic().ImportLabelmapToSegmentationNode(labelmapVolumeNode, segmentationNode)
+    message = {
+        'command': 'segment',
+        'mode': int(mode),
+        'iterations': iterations,
+        'smoothing': int(float(smoothing)),
+        'threshold': float(threshold),
+        'balloon': ballon,
+        'roi': bool(roi),
+        'pyramid': bool(pyramid),
+        'volume': (volumeNode.GetID(), volumeNode.GetImageData().GetMTime()),
+        'done': done}
+
+    if np.ndim(ras) == 1:
+      message['coord'] = coords[0]
+      return SnakeJob(data, message, showPreview if pyramid else None, onProgress, finished,
+                      showLive if live else None, init)
+    # The volume is sent once and every seed gets a label of its own
+    message['coords'] = coords
+    return SnakeJob(data, message, None, onProgress, finished, None, init)
+
+  def submit(self, jobQueue, mode, volumeNode, ras, enableBaloonFlag, iterations, smoothing, threshold, color, name,
+             roi=False, pyramid=False, live=False, resume=False, initSegment=None, onProgress=None, onFinished=None):
+    """
+    Queue the job of createJob in jobQueue and return it, without waiting
+    for it
+    """
+    logging.info('Processing queued')
+    job = self.createJob(mode, volumeNode, ras, enableBaloonFlag, iterations, smoothing, threshold, color, name,
+                         roi, pyramid, live, resume, initSegment, onProgress, onFinished)
+    return jobQueue.submit(job)
+
+  def sweepName(self, name, mode, variant):
+    """Name of the segment of a variant of a sweep, with the parameters that
+    matter to mode."""
+    name = '%s it=%d sm=%d' % (name, variant['iterations'], variant['smoothing'])
+    if mode in (2, 3):
+      name += ' th=%g b=%g' % (variant['threshold'], variant['balloon'])
+    return name
+
+  def showSweep(self, segmentationNode, volumeNode, result, names):
+    """Replace the contents of segmentationNode by a segment for every
+    variant of a sweep with a non-empty mask, in colors far apart. result
+    holds the masks of the variants as the worker packs them: the mask of
+    variant i is bit i % 8 of plane i // 8."""
+    planes, box = unpackResult(result)
+    wasModified = segmentationNode.StartModify()
+    segmentation = segmentationNode.GetSegmentation()
+    segmentation.RemoveAllSegments()
+    for i, name in enumerate(names):
+      # The planes are cropped to the variants with a mask too
+      plane = i // 8 - box[0].start
+      if not 0 <= plane < len(planes):
+        continue
+      mask = (planes[plane] >> (i % 8)) & 1
+      if not mask.any():
+        continue
+      labelmapVolumeNode = self.labelmapFromArray(volumeNode, mask, name, box[1:])
+      slicer.modules.segmentations.logic().ImportLabelmapToSegmentationNode(labelmapVolumeNode, segmentationNode)
+      slicer.mrmlScene.RemoveNode(labelmapVolumeNode)
+      color = qt.QColor.fromHsvF(float(i) / len(names), 0.8, 1.0)
+      segment = segmentation.GetNthSegment(segmentation.GetNumberOfSegments() - 1)
+      segment.SetName(name)
+      segment.SetColor(color.redF(), color.greenF(), color.blueF())
     segmentationNode.CreateClosedSurfaceRepresentation()
-    slicer.mrmlScene.RemoveNode(labelmapVolumeNode)
-    segmentationNode.RemoveSegment(tempSegment)
+    segmentationNode.EndModify(wasModified)
+
+  def createSweepJob(self, mode, volumeNode, ras, grid, name, roi=False, pyramid=False,
+                     onProgress=None, onFinished=None):
+    """
+    Create the job segmenting volumeNode around the seed ras with every
+    combination of the values of grid, a dictionary of lists of iterations,
+    smoothing, threshold and balloon, which shows every result in a segment
+    of a new segmentation node when it is done
+
+    The volume is sent once and the worker shares what the variants have in
+    common, so a sweep is cheaper than a job per variant.
+    """
+    coords = self.seedCoords(volumeNode, [ras])
+    data = slicer.util.arrayFromVolume(volumeNode)
+    grid = {'iterations': [int(float(v)) for v in grid['iterations']],
+            'smoothing': [int(float(v)) for v in grid['smoothing']],
+            'threshold': [float(v) for v in grid['threshold']],
+            'balloon': [float(v) for v in grid['balloon']]}
 
+    segmentationNode = slicer.vtkMRMLSegmentationNode()
+    slicer.mrmlScene.AddNode(segmentationNode)
+    segmentationNode.CreateDefaultDisplayNodes()
+    segmentationNode.SetReferenceImageGeometryParameterFromVolumeNode(volumeNode)
+    segmentationNode.SetName(name + ' (sweep)')
 
-    print('Zrobione')
+    def finished(job):
+      if job.state == 'done':
+        variants = job.reply['variants']
+        names = [self.sweepName(name, mode, variant) for variant in variants]
+        for segmentName, voxels in zip(names, job.reply['counts']):
+          if voxels == 0:
+            logging.warning('Nothing was segmented with %s' % segmentName)
+        self.showSweep(segmentationNode, volumeNode, job.result, names)
+      else:
+        slicer.mrmlScene.RemoveNode(segmentationNode)
+        if job.state == 'failed':
+          logging.error('Sweep failed: %s' % job.error)
+      if onFinished is not None:
+        onFinished(job)
 
+    message = {
+        'command': 'sweep',
+        'mode': int(mode),
+        'grid': grid,
+        'coord': coords[0],
+        'roi': bool(roi),
+        'pyramid': bool(pyramid),
+        'volume': (volumeNode.GetID(), volumeNode.GetImageData().GetMTime())}
+    return SnakeJob(data, message, None, onProgress, finished)
+
+  def submitSweep(self, jobQueue, mode, volumeNode, ras, grid, name, roi=False, pyramid=False,
+                  onProgress=None, onFinished=None):
+    """
+    Queue the job of createSweepJob in jobQueue and return it, without
+    waiting for it
+    """
+    logging.info('Sweep queued')
+    job = self.createSweepJob(mode, volumeNode, ras, grid, name, roi, pyramid, onProgress, onFinished)
+    return jobQueue.submit(job)
+
+  def run(self, mode, volumeNode, ras, enableBaloonFlag, iterations, smoothing, threshold, color, name, roi=False, pyramid=False,
+          live=False, resume=False, initSegment=None):
+    """
+    Run the actual algorithm, waiting for it
+
+    ras is the seed, or a list of seeds whose objects are segmented in a
+    single run of the worker, each in a segment of its own.
+    """
+    logging.info('Processing started')
+    job = self.createJob(mode, volumeNode, ras, enableBaloonFlag, iterations, smoothing, threshold, color, name,
+                         roi, pyramid, live, resume, initSegment)
+    print('Snake')
+    job.run(snakeWorker())
     return True
 
 
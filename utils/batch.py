@@ -0,0 +1,401 @@
+"""Headless batch segmentation of whole studies.
+
+Segments every case of a JSON manifest without Slicer, spreading the cases
+over a pool of processes:
+
+    python3 batch.py manifest.json --output results
+    python3 batch.py manifest.json --output results --processes 4 --memory 16
+
+The manifest lists the volumes, their seeds and the parameters of the snakes,
+which default to those of the selector module and can be set for all the
+cases at once:
+
+    {
+     "defaults": {"mode": 2, "iterations": 50, "roi": true},
+     "cases": [
+      {"id": "case001", "image": "case001.nrrd", "seed": [120, 88, 40]},
+      {"image": "case002.npy", "seeds": [[60, 70, 12], [90, 70, 12]],
+       "mode": 0}
+     ]
+    }
+
+Seeds are voxel coordinates [i, j, k], as the worker takes them, and a case
+with several `seeds` gets a label volume as `snake.segment_seeds` makes it.
+Images are read according to their extension by `READERS`: .npy files are
+memory mapped and NRRD files need the pynrrd package. Other formats are read
+by passing `--reader .ext=module:function`, a function returning the volume
+as an array of [k, j, i] and the metadata the writer of the results may use.
+
+Every case writes its mask as <id>.npy (or .nrrd with --format .nrrd, keeping
+the geometry of an NRRD input) and a record <id>.json with its status,
+timing and log, both atomically, and summary.json is rewritten as the cases
+end. An interrupted batch is resumed by running it again: cases whose record
+says they are done with the same image, seeds and parameters are skipped,
+failed ones are run again. A process that dies, e.g. killed for lack of
+memory, fails the cases it was running with the others of the pool at the
+time, and the pool is restarted for the rest.
+
+The cases run largest first, as many at a time as there are processes and
+their estimated peak memory fits in the `--memory` budget, by default most of
+the memory available when the batch starts. A case is always run when nothing
+else is, even if it alone does not fit.
+"""
+import argparse
+import contextlib
+import importlib
+import io
+import json
+import os
+import time
+import traceback
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+
+import numpy as np
+
+import snake
+
+
+# Defaults of the selector module
+PARAMETERS = {
+    'mode': 0,
+    'iterations': 20,
+    'smoothing': 1,
+    'threshold': 0.5,
+    'balloon': 1,
+    'roi': True,
+    'batched': False,
+    'pyramid': False,
+    'adaptive': False,
+}
+
+# Peak memory of the modes in bytes per voxel of the volume, besides the
+# volume itself: the level sets and the result of ACWE, and for GAC also its
+# single precision edge map and gradient
+MODE_BYTES_PER_VOXEL = {0: 8, 1: 8, 2: 26, 3: 26, 4: 8}
+
+# Part of the available memory the cases may use by default
+MEMORY_FRACTION = 0.8
+
+
+def read_npy(path):
+    return np.load(path, mmap_mode='r'), None
+
+
+def read_nrrd(path):
+    # Optional, only needed for NRRD studies
+    import nrrd
+
+    # C order gives the [k, j, i] layout of the volumes of Slicer
+    return nrrd.read(path, index_order='C')
+
+
+def write_npy(path, ls, meta):
+    with open(path, 'wb') as f:
+        np.save(f, ls)
+
+
+def write_nrrd(path, ls, meta):
+    import nrrd
+
+    header = {}
+    if meta is not None:
+        # The mask keeps the geometry of the volume it was segmented in
+        header = {key: meta[key] for key in
+                  ('space', 'space directions', 'space origin', 'kinds')
+                  if key in meta}
+    nrrd.write(path, ls, header, index_order='C')
+
+
+READERS = {
+    '.npy': read_npy,
+    '.nrrd': read_nrrd,
+    '.nhdr': read_nrrd,
+}
+
+WRITERS = {
+    '.npy': write_npy,
+    '.nrrd': write_nrrd,
+}
+
+
+def load_function(name):
+    """Function `name`, given as 'module:function'."""
+    module, function = name.split(':')
+    return getattr(importlib.import_module(module), function)
+
+
+def reader_for(path, readers=None):
+    """Reader of `path` by its extension, from `readers`, a dictionary of
+    extensions to 'module:function' names, or `READERS`."""
+    extension = os.path.splitext(path)[1].lower()
+    if readers and extension in readers:
+        return load_function(readers[extension])
+    if extension in READERS:
+        return READERS[extension]
+    raise ValueError("No reader for %s files: %s" % (extension, path))
+
+
+def volume_info(path, readers=None):
+    """Number of voxels and bytes per voxel of the volume of `path`, from its
+    header only."""
+    extension = os.path.splitext(path)[1].lower()
+    if not (readers and extension in readers):
+        if extension == '.npy':
+            img = np.load(path, mmap_mode='r')
+            return img.size, img.itemsize
+        if extension in ('.nrrd', '.nhdr'):
+            import nrrd
+            header = nrrd.read_header(path)
+            return int(np.prod(header['sizes'])), np.dtype(header['type']).itemsize
+    # Other readers are not run here, where a crash would stop the batch, so
+    # the file is taken for raw 16 bit voxels
+    return os.path.getsize(path) // 2, 2
+
+
+def estimate_memory(voxels, itemsize, mode):
+    """Estimated peak memory in bytes of segmenting a volume."""
+    return voxels * (itemsize + MODE_BYTES_PER_VOXEL[mode])
+
+
+def available_memory():
+    """Memory available to new processes in bytes."""
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+
+
+def load_manifest(path):
+    """Cases of the manifest `path`, with their parameters filled in and
+    their images relative to the manifest resolved."""
+    with open(path) as f:
+        manifest = json.load(f)
+    root = os.path.dirname(os.path.abspath(path))
+    defaults = dict(PARAMETERS, **manifest.get('defaults', {}))
+
+    cases = []
+    ids = set()
+    for case in manifest['cases']:
+        case = dict(defaults, **case)
+        case['image'] = os.path.join(root, case['image'])
+        case.setdefault('id', os.path.splitext(os.path.basename(case['image']))[0])
+        if case['id'] in ids:
+            raise ValueError("Duplicate case id: %s" % case['id'])
+        if ('seed' in case) == ('seeds' in case):
+            raise ValueError("Case %s needs either a seed or seeds" % case['id'])
+        if case['mode'] not in MODE_BYTES_PER_VOXEL:
+            raise ValueError("Unknown mode of case %s: %s" % (case['id'], case['mode']))
+        ids.add(case['id'])
+        cases.append(case)
+    return cases
+
+
+def write_json(path, data):
+    """Write `data` to `path` atomically, so a crash leaves either the old or
+    the new file."""
+    with open(path + '.tmp', 'w') as f:
+        json.dump(data, f, indent=1)
+    os.replace(path + '.tmp', path)
+
+
+def record_path(output, case):
+    return os.path.join(output, case['id'] + '.json')
+
+
+def is_done(output, case):
+    """Whether `case` has already been segmented, with the same parameters."""
+    try:
+        with open(record_path(output, case)) as f:
+            record = json.load(f)
+    except (OSError, ValueError):
+        return False
+    return (record.get('status') == 'done' and record.get('case') == case and
+            os.path.exists(os.path.join(output, record['output'])))
+
+
+def run_case(case, output, extension='.npy', workers=1, readers=None):
+    """Segment `case` and write its mask and its record to `output`.
+
+    Returns the record. Failures are recorded instead of raised.
+    """
+    record = {'id': case['id'], 'case': case, 'pid': os.getpid()}
+    log = io.StringIO()
+    start = time.time()
+    try:
+        with contextlib.redirect_stdout(log):
+            img, meta = reader_for(case['image'], readers)(case['image'])
+            arguments = (case['mode'], img)
+            parameters = (case['iterations'], case['smoothing'],
+                          case['threshold'], case['balloon'], case['roi'],
+                          workers, case['batched'], case['pyramid'])
+            if 'seeds' in case:
+                ls = snake.segment_seeds(*arguments + (case['seeds'],) + parameters,
+                                         adaptive=case['adaptive'])
+                counts = np.bincount(ls.ravel(), minlength=len(case['seeds']) + 1)
+                record['counts'] = counts[1:].tolist()
+            else:
+                ls = snake.segment(*arguments + (case['seed'],) + parameters,
+                                   adaptive=case['adaptive'])
+            record['voxels'] = int(np.count_nonzero(ls))
+
+            name = case['id'] + extension
+            path = os.path.join(output, name)
+            WRITERS[extension](path + '.tmp', ls.astype(np.uint8, copy=False), meta)
+            os.replace(path + '.tmp', path)
+            record['output'] = name
+        record['status'] = 'done'
+    except Exception:
+        record['status'] = 'failed'
+        record['error'] = traceback.format_exc()
+    record['time'] = time.time() - start
+    record['log'] = log.getvalue()
+    write_json(record_path(output, case), record)
+    return record
+
+
+def schedule(cases, output, processes, memory, extension='.npy',
+             readers=None, log=print):
+    """Run `cases`, (case, estimated memory) pairs, on a pool of `processes`
+    processes without exceeding `memory` bytes, and yield their records as
+    they end."""
+    # The largest cases first, so none is left running alone at the end
+    pending = deque(sorted(cases, key=lambda pair: -pair[1]))
+    workers = max((os.cpu_count() or 1) // processes, 1)
+    running = {}
+    pool = ProcessPoolExecutor(processes)
+    try:
+        while pending or running:
+            used = sum(need for _, need in running.values())
+            while pending and len(running) < processes:
+                if running and used + pending[0][1] > memory:
+                    break
+                case, need = pending.popleft()
+                used += need
+                future = pool.submit(run_case, case, output, extension, workers,
+                                     readers)
+                running[future] = case, need
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            broken = False
+            for future in finished:
+                case, _ = running.pop(future)
+                try:
+                    yield future.result()
+                except BrokenProcessPool:
+                    # A process died, e.g. killed for lack of memory, and took
+                    # the pool down with the cases it was running
+                    broken = True
+                    record = {'id': case['id'], 'case': case, 'status': 'failed',
+                              'error': 'The process segmenting the case died'}
+                    write_json(record_path(output, case), record)
+                    yield record
+            if broken:
+                log('Restarting the pool of processes')
+                pool.shutdown(wait=False)
+                pending.extendleft(running.values())
+                running.clear()
+                pool = ProcessPoolExecutor(processes)
+    finally:
+        pool.shutdown()
+
+
+def format_record(record):
+    line = '%-24s %-6s' % (record['id'], record['status'])
+    if 'time' in record:
+        line += '  %8.2f s' % record['time']
+    if 'voxels' in record:
+        line += '  %10d voxels' % record['voxels']
+    if record['status'] == 'failed':
+        line += '  ' + record['error'].strip().splitlines()[-1]
+    return line
+
+
+def batch(cases, output, processes=None, memory=None, extension='.npy',
+          readers=None, force=False, log=print):
+    """Segment `cases` into the directory `output` and return the summary."""
+    os.makedirs(output, exist_ok=True)
+    processes = processes or os.cpu_count() or 1
+    if memory is None:
+        memory = MEMORY_FRACTION * available_memory()
+
+    records = {}
+    todo = []
+    for case in cases:
+        if not force and is_done(output, case):
+            with open(record_path(output, case)) as f:
+                records[case['id']] = dict(json.load(f), skipped=True)
+            continue
+        try:
+            voxels, itemsize = volume_info(case['image'], readers)
+        except Exception:
+            records[case['id']] = record = {
+                'id': case['id'], 'case': case, 'status': 'failed',
+                'error': traceback.format_exc()}
+            write_json(record_path(output, case), record)
+            log(format_record(record))
+            continue
+        todo.append((case, estimate_memory(voxels, itemsize, case['mode'])))
+    if records:
+        log('%d cases already done or unreadable, %d to run' %
+            (len(records), len(todo)))
+
+    def summary():
+        ordered = [records[case['id']] for case in cases if case['id'] in records]
+        return {
+            'cases': ordered,
+            'done': sum(r['status'] == 'done' for r in ordered),
+            'failed': sum(r['status'] == 'failed' for r in ordered),
+            'pending': len(cases) - len(ordered),
+            'seconds': sum(r.get('time', 0.0) for r in ordered),
+        }
+
+    start = time.time()
+    for record in schedule(todo, output, processes, memory, extension, readers,
+                           log):
+        records[record['id']] = record
+        write_json(os.path.join(output, 'summary.json'), summary())
+        log(format_record(record))
+
+    result = summary()
+    result['elapsed'] = time.time() - start
+    write_json(os.path.join(output, 'summary.json'), result)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('manifest', help='JSON manifest of the cases')
+    parser.add_argument('--output', required=True,
+                        help='directory of the masks, records and summary')
+    parser.add_argument('--processes', type=int,
+                        help='cases segmented at a time, by default the CPUs')
+    parser.add_argument('--memory', type=float,
+                        help='memory budget of the cases in GB, by default '
+                             '%d%% of the available memory' %
+                             (100 * MEMORY_FRACTION))
+    parser.add_argument('--format', choices=sorted(WRITERS), default='.npy',
+                        help='file format of the masks')
+    parser.add_argument('--reader', action='append', default=[],
+                        metavar='.EXT=MODULE:FUNCTION',
+                        help='reader of the images with extension .EXT')
+    parser.add_argument('--force', action='store_true',
+                        help='segment the cases that are already done again')
+    args = parser.parse_args()
+
+    readers = dict(reader.split('=', 1) for reader in args.reader)
+    readers = {extension.lower(): name for extension, name in readers.items()}
+    memory = args.memory * 1024.0**3 if args.memory else None
+    result = batch(load_manifest(args.manifest), args.output, args.processes,
+                   memory, args.format, readers, args.force)
+    print('%d done, %d failed in %.1f s' % (result['done'], result['failed'],
+                                            result['elapsed']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,241 @@
+"""Benchmarks of the snakes on synthetic phantoms.
+
+Generates reproducible noisy int16 volumes (a sphere, an ellipsoid and two
+touching blobs) of several sizes, times the five segmentation modes of
+`snake` and the primitives of `morphsnakes` on them, and saves the results as
+JSON so runs on different commits can be compared:
+
+    python3 benchmark.py --sizes 128 256 --output before.json
+    python3 benchmark.py --sizes 128 256 --compare before.json
+
+Every case records its time in seconds, its throughput in voxels of the
+volume per second, and its peak memory as traced by `tracemalloc`, which sees
+the numpy arrays allocated by the case but not the phantom itself. The
+segmentation modes also record the Dice coefficient of their result against
+the object of the phantom, so a speed-up that changes the masks shows up.
+The memory is measured in a separate run from the timing, as tracing slows
+the allocations down.
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import subprocess
+import time
+import tracemalloc
+
+import numpy as np
+import scipy
+
+import morphsnakes as ms
+import snake
+
+
+PHANTOMS = ('sphere', 'ellipsoid', 'blobs')
+SIZES = (128, 256, 512)
+MODES = {
+    0: 'acwe3d',
+    1: 'acwe2d',
+    2: 'gac3d',
+    3: 'gac2d',
+    4: 'acwe2d_prev',
+}
+
+# Defaults of the selector module
+ITERATIONS = 20
+SMOOTHING = 1
+THRESHOLD = 0.5
+BALLOON = 1
+
+
+def phantom(name, size, seed=0):
+    """Noisy int16 phantom `name` of `size` voxels per side.
+
+    Returns the volume, its object as a boolean mask, and a point inside the
+    object as the [x, y, z] coordinate the modes take.
+    """
+    if name == 'sphere':
+        def inside(z, y, x):
+            return (z - 0.5)**2 + (y - 0.5)**2 + (x - 0.5)**2 < 0.3**2, 0
+        center = (0.5, 0.5, 0.5)
+    elif name == 'ellipsoid':
+        def inside(z, y, x):
+            return ((z - 0.5) / 0.2)**2 + ((y - 0.5) / 0.35)**2 + \
+                ((x - 0.5) / 0.3)**2 < 1, 0
+        center = (0.5, 0.5, 0.5)
+    elif name == 'blobs':
+        # Two spheres of different intensities touching at the center
+        def inside(z, y, x):
+            left = (z - 0.5)**2 + (y - 0.5)**2 + (x - 0.3)**2 < 0.2**2
+            right = (z - 0.5)**2 + (y - 0.5)**2 + (x - 0.7)**2 < 0.2**2
+            return left | right, 40 * right
+        center = (0.5, 0.5, 0.3)
+    else:
+        raise ValueError("Unknown phantom: %s" % name)
+
+    # Built slice by slice, so the 512 voxels phantoms do not need float
+    # arrays of their size
+    rng = np.random.RandomState(seed)
+    y, x = (g / float(size) for g in np.ogrid[:size, :size])
+    img = np.empty((size,) * 3, dtype=np.int16)
+    truth = np.empty((size,) * 3, dtype=bool)
+    for i in range(size):
+        truth[i], extra = inside(i / float(size), y, x)
+        img[i] = rng.normal(0, 20, (size, size)) + 100 * truth[i] + extra
+    coord = [int(c * size) for c in center[::-1]]
+    return img, truth, coord
+
+
+def dice(ls, truth):
+    """Dice coefficient of the segmentation `ls` against `truth`."""
+    ls = ls > 0
+    return 2.0 * np.count_nonzero(ls & truth) / \
+        (np.count_nonzero(ls) + np.count_nonzero(truth))
+
+
+def measure(run, repeat=1, memory=True):
+    """Time `run()`, the best of `repeat` runs, and trace the peak memory of
+    one more run. Returns the seconds, the peak bytes and the result."""
+    seconds = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = run()
+        elapsed = time.perf_counter() - start
+        seconds = elapsed if seconds is None else min(seconds, elapsed)
+
+    peak = None
+    if memory:
+        tracemalloc.start()
+        try:
+            run()
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return seconds, peak, result
+
+
+def cases(img, truth, coord, modes, iterations):
+    """Benchmark cases on one phantom, as (name, run, truth) tuples."""
+    ls = ms.circle_level_set(img.shape, coord[::-1], img.shape[0] // 4)
+    workspace = ms.Workspace()
+    yield 'circle_level_set', \
+        lambda: ms.circle_level_set(img.shape, coord[::-1], 5), None
+    yield 'sup_inf', lambda: ms.sup_inf(ls, workspace=workspace), None
+    yield 'inf_sup', lambda: ms.inf_sup(ls, workspace=workspace), None
+
+    for mode in modes:
+        def run(mode=mode):
+            # The modes report their progress on the standard output
+            with contextlib.redirect_stdout(io.StringIO()):
+                return snake.segment(mode, img, coord, iterations, SMOOTHING,
+                                     THRESHOLD, BALLOON)
+        yield MODES[mode], run, truth
+
+
+def environment():
+    """Description of the machine and the code the benchmark runs on."""
+    try:
+        commit = subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+            cwd=os.path.dirname(os.path.realpath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'commit': commit,
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'scipy': scipy.__version__,
+        'machine': platform.machine(),
+        'cpus': os.cpu_count(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    }
+
+
+def benchmark(phantoms=PHANTOMS, sizes=SIZES, modes=tuple(MODES),
+              iterations=ITERATIONS, repeat=1, memory=True, log=print):
+    """Run every case on every phantom and return the results."""
+    results = []
+    for size in sizes:
+        for name in phantoms:
+            img, truth, coord = phantom(name, size)
+            for case, run, case_truth in cases(img, truth, coord, modes,
+                                               iterations):
+                seconds, peak, ls = measure(run, repeat, memory)
+                result = {
+                    'case': case,
+                    'phantom': name,
+                    'size': size,
+                    'seconds': seconds,
+                    'voxels_per_second': img.size / seconds,
+                    'peak_bytes': peak,
+                }
+                if case_truth is not None:
+                    result['dice'] = dice(ls, case_truth)
+                results.append(result)
+                log(format_result(result))
+    return results
+
+
+def format_result(result):
+    line = '%-16s %-9s %4d  %8.3f s  %10.3g voxels/s' % (
+        result['case'], result['phantom'], result['size'], result['seconds'],
+        result['voxels_per_second'])
+    if result['peak_bytes'] is not None:
+        line += '  %8.1f MB' % (result['peak_bytes'] / 1024.0**2)
+    if 'dice' in result:
+        line += '  dice %.4f' % result['dice']
+    return line
+
+
+def compare(results, reference, log=print):
+    """Print the speed-up and the memory ratio of `results` over the
+    matching cases of `reference`."""
+    key = lambda r: (r['case'], r['phantom'], r['size'])
+    previous = {key(r): r for r in reference}
+    for result in results:
+        old = previous.get(key(result))
+        if old is None:
+            continue
+        line = '%-16s %-9s %4d  speed x%.2f' % (
+            key(result) + (old['seconds'] / result['seconds'],))
+        if result['peak_bytes'] and old['peak_bytes']:
+            line += '  memory x%.2f' % (result['peak_bytes'] /
+                                        float(old['peak_bytes']))
+        if 'dice' in result and 'dice' in old:
+            line += '  dice %+.4f' % (result['dice'] - old['dice'])
+        log(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES)
+    parser.add_argument('--phantoms', nargs='+', choices=PHANTOMS,
+                        default=PHANTOMS)
+    parser.add_argument('--modes', type=int, nargs='+', choices=sorted(MODES),
+                        default=sorted(MODES))
+    parser.add_argument('--iterations', type=int, default=ITERATIONS)
+    parser.add_argument('--repeat', type=int, default=1,
+                        help='timed runs per case, the best one is kept')
+    parser.add_argument('--no-memory', dest='memory', action='store_false',
+                        help='do not run the cases again to trace memory')
+    parser.add_argument('--output', help='JSON file to save the results to')
+    parser.add_argument('--compare', help='JSON file of an earlier run')
+    args = parser.parse_args()
+
+    results = benchmark(args.phantoms, args.sizes, args.modes,
+                        args.iterations, args.repeat, args.memory)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'environment': environment(), 'results': results}, f,
+                      indent=1)
+    if args.compare:
+        with open(args.compare) as f:
+            reference = json.load(f)
+        print()
+        compare(results, reference['results'])
+
+
+if __name__ == '__main__':
+    main()
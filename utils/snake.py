@@ -1,16 +1,22 @@
 import numpy as np
 import os
 import morphsnakes as ms
+from scipy import ndimage as ndi
+import itertools
 import sys
+import threading
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
 from morphsnakes import (
     morphological_geodesic_active_contour, inverse_gaussian_gradient,
     circle_level_set)
-import matplotlib
-from matplotlib import pyplot as plt
 import time
 
 
 def save_img(img, ls, name):
+    # Only needed for debugging, so matplotlib is not imported on startup
+    from matplotlib import pyplot as plt
+
     fig, ax = plt.subplots()
 
     ax.imshow(img)
@@ -39,165 +45,1100 @@ def middle_of_line(row):
         i += 1
     return int((end + start) / 2)
 
-def acwe3d(img, coord, iterations, smoothing):
+
+# Margin (in voxels) of the region of interest around the seed, and number of
+# iterations between checks of whether the contour reached its border. Every
+# run on the region continues the alternation of the smoothing operators where
+# the previous one stopped, so the chunks do not change the result.
+ROI_MARGIN = 16
+ROI_CHUNK = 4
+
+# The evolutions stop once the level set has not changed for this many
+# iterations or oscillates, which gives the same result as running them all.
+CONVERGENCE_WINDOW = 2
+
+
+def roi_box(ls, margin):
+    """Bounding box of the level set `ls` grown by `margin` voxels."""
+    box = []
+    for axis, n in enumerate(ls.shape):
+        other = tuple(i for i in range(ls.ndim) if i != axis)
+        idx = np.flatnonzero(ls.any(axis=other))
+        if len(idx) == 0:
+            return tuple(slice(0, n) for n in ls.shape)
+        box.append(slice(max(idx[0] - margin, 0), min(idx[-1] + 1 + margin, n)))
+    return tuple(box)
+
+
+def grow_roi_box(box, margin, shape):
+    return tuple(slice(max(s.start - margin, 0), min(s.stop + margin, n))
+                 for s, n in zip(box, shape))
+
+
+def touches_roi_border(ls, box, width):
+    """Whether `ls` is within `width` voxels of a side of `box` that is not
+    the border of the image."""
+    sub = ls[box]
+    for axis, (s, n) in enumerate(zip(box, ls.shape)):
+        sides = []
+        if s.start > 0:
+            sides.append(slice(0, width))
+        if s.stop < n:
+            sides.append(slice(-width, None))
+        for side in sides:
+            idx = [slice(None)] * ls.ndim
+            idx[axis] = side
+            if sub[tuple(idx)].any():
+                return True
+    return False
+
+
+def evolve_roi(evolve, init_ls, iterations, margin=ROI_MARGIN,
+               chunk=ROI_CHUNK):
+    """Run `evolve(box, init_ls, iterations, start)` on a box around the seed.
+
+    The box starts around `init_ls` and grows by `margin` voxels whenever the
+    contour gets close to it, continuing from the current level set after the
+    `start` iterations already run. `evolve` returns the level set and the
+    information of the evolution; the whole evolution stops when one of them
+    stops early away from the border of the box. The result is returned with
+    the shape of `init_ls`.
+    """
+    ls = np.int8(init_ls > 0)
+    box = roi_box(ls, margin)
+    done = 0
+    while done < iterations:
+        n = min(chunk, iterations - done)
+        ls[box], info = evolve(box, ls[box], n, done)
+        done += n
+        if touches_roi_border(ls, box, chunk):
+            while touches_roi_border(ls, box, chunk):
+                box = grow_roi_box(box, margin, ls.shape)
+        elif info['reason'] != 'iterations':
+            # An oscillation alternates between two level sets, pick the one
+            # the remaining iterations would end on
+            if info['reason'] == 'oscillation' and (iterations - done) % 2:
+                ls[box] = evolve(box, ls[box], 1, done)[0]
+            break
+    return ls
+
+
+# Number of threads segmenting the slices of the 2D modes. scipy.ndimage
+# releases the GIL, so the slices are segmented in parallel.
+WORKERS = os.cpu_count() or 1
+
+
+def for_each_slice(segment_slice, slices, workers=WORKERS):
+    """Call `segment_slice(line, workspace)` for every line of `slices`.
+
+    With more than one worker the slices are shared by a pool of threads, each
+    with a workspace of its own. Every slice writes only its own part of the
+    result, so the result does not depend on the order the slices are run in.
+    """
+    if workers <= 1 or len(slices) <= 1:
+        workspace = ms.Workspace()
+        for line in slices:
+            segment_slice(line, workspace)
+        return
+
+    local = threading.local()
+
+    def run(line):
+        if not hasattr(local, 'workspace'):
+            local.workspace = ms.Workspace()
+        segment_slice(line, local.workspace)
+
+    with ThreadPool(min(workers, len(slices))) as pool:
+        pool.map(run, slices)
+
+
+# Number of times the 3D modes halve the resolution in pyramid mode at most,
+# and number of iterations run at each finer level to refine the coarse result.
+PYRAMID_LEVELS = 2
+PYRAMID_REFINE = 10
+
+# Radius of the seed ball of the pyramid in voxels of the coarsest level, at
+# least: smaller balls vanish under the smoothing. The object must also hold a
+# ball twice as large, i.e. the image in it may differ on average from the
+# image around the seed by this many of its standard deviations at most.
+PYRAMID_MIN_RADIUS = 2
+PYRAMID_FIT = 1.0
+
+
+def downsample(a, reduce=np.mean):
+    """Halve the resolution of `a`, combining blocks of 2 voxels per axis with
+    `reduce`. Odd sizes are padded by repeating the last voxel."""
+    shape = tuple((n + 1) // 2 for n in a.shape)
+    a = np.pad(a, [(0, 2 * m - n) for m, n in zip(shape, a.shape)], mode='edge')
+    blocks = a.reshape(sum(((m, 2) for m in shape), ()))
+    return reduce(blocks, axis=tuple(range(1, 2 * a.ndim, 2)))
+
+
+def upsample(ls, shape):
+    """Double the resolution of the level set `ls` and crop it to `shape`."""
+    for axis in range(ls.ndim):
+        ls = np.repeat(ls, 2, axis=axis)
+    return ls[tuple(slice(0, n) for n in shape)]
+
+
+def ball_statistics(image, center, radius):
+    """Mean and standard deviation of `image` in the ball of `radius` voxels
+    around `center`."""
+    box = tuple(slice(max(c - radius, 0), c + radius + 1) for c in center)
+    grid = np.ogrid[box]
+    inside = sum((g - c) ** 2 for g, c in zip(grid, center)) < radius ** 2
+    values = image[box][inside]
+    return values.mean(dtype=np.float64), values.std(dtype=np.float64)
+
+
+def pyramid_radius(radius, level, min_radius=PYRAMID_MIN_RADIUS):
+    """Radius, in voxels of `level`, of the seed ball of `radius` voxels at
+    full resolution."""
+    return max(radius >> level, min_radius)
+
+
+def pyramid_levels(image, center, radius, levels=PYRAMID_LEVELS,
+                   fit=PYRAMID_FIT):
+    """Number of times, up to `levels`, `evolve_pyramid` can halve the
+    resolution of `image` with the seed ball still inside the object.
+
+    The ball of `radius` voxels around `center` at full resolution is assumed
+    to be inside, as in the other modes. At a coarser level, where the ball
+    keeps a minimum radius, it covers more of the image, and the object is
+    taken as large enough while the mean of the image in a ball of twice that
+    size stays within `fit` standard deviations of the mean in the ball at
+    full resolution. Objects not much larger than the coarse ball would be
+    lost, or leaked out of, at that level.
+    """
+    mean, std = ball_statistics(image, center, radius)
+    level = 0
+    while level < levels:
+        cover = 2 * pyramid_radius(radius, level + 1) << (level + 1)
+        if abs(ball_statistics(image, center, cover)[0] - mean) > fit * std:
+            break
+        level += 1
+    return level
+
+
+def evolve_pyramid(evolve, image, center, radius, iterations,
+                   levels=PYRAMID_LEVELS, refine=PYRAMID_REFINE, preview=None):
+    """Run `evolve(image, init_ls, iterations)` from coarse to fine resolution.
+
+    All the iterations run on `image` downsampled `levels` times, where the
+    contour covers more of the image per iteration, starting from the ball of
+    `radius` voxels around `center`, both given at full resolution, at the
+    radius `pyramid_radius` gives. `levels` is usually the number
+    `pyramid_levels` gives for the ball. The result initializes the next
+    finer level, which only runs `refine` iterations. `preview` is called
+    with the result of every coarse level at full resolution.
+    """
+    images = [image]
+    for _ in range(levels):
+        images.append(downsample(images[-1]))
+
+    ls = ms.circle_level_set(images[-1].shape,
+                             tuple(c // 2 ** levels for c in center),
+                             pyramid_radius(radius, levels))
+    for level in range(levels, -1, -1):
+        n = iterations if level == levels else min(refine, iterations)
+        ls = evolve(images[level], ls, n)
+        if level == 0:
+            break
+        ls = upsample(ls, images[level - 1].shape)
+        if preview is not None:
+            full = ls
+            for finer in range(level - 2, -1, -1):
+                full = upsample(full, images[finer].shape)
+            preview(full)
+    return ls
+
+
+# Bounds of the iterations of the warm-started slices of acwe2d_prev with
+# adaptive budgets. They are even, so every slice ends with the same smoothing
+# operator.
+WARM_START_MIN = 2
+WARM_START_MARGIN = 2
+
+
+def warm_start_budget(init_ls, ls, iterations):
+    """Iterations for the slice after one evolved from `init_ls` to `ls`.
+
+    The contour moves at most a voxel per iteration, so the next slice gets
+    twice the average distance the contour moved on this one, as it may move
+    unevenly, plus a margin, between WARM_START_MIN and `iterations`.
+    """
+    contour = np.count_nonzero(ls & ~ndi.binary_erosion(ls))
+    if contour == 0:
+        return iterations
+    shift = np.count_nonzero(init_ls != ls) / float(contour)
+    budget = 2 * int(np.ceil(shift)) + WARM_START_MARGIN
+    budget += budget % 2
+    return int(min(max(budget, WARM_START_MIN), iterations))
+
+
+def slice_level_sets(img, slices, coord):
+    """Initial level sets of the slices of the 2D modes, as a stack."""
+    return np.array([ms.circle_level_set(img.shape[1:], (line[1], coord[0]), 5)
+                     for line in slices])
+
+
+def range_slices(range_ls):
+    """Slices of the 2D modes the level set `range_ls` of the range plane
+    crosses, as [row, column of its seed] pairs."""
+    return [[i, middle_of_line(row)] for i, row in enumerate(range_ls) if row.any()]
+
+
+def evolve_range(evolve, init_ls, iterations, done=0):
+    """Evolve the range plane of the 2D modes with `evolve(init_ls,
+    iterations, done)` as a single evolution of `iterations`.
+
+    With `done`, the evolution is split after `done` iterations, and the
+    slices the range plane gave then, those of an earlier result of `done`
+    iterations, are returned with its level set; otherwise they are None.
+    """
+    if not done:
+        return evolve(init_ls, iterations, 0), None
+    ls = evolve(init_ls, done, 0)
+    return evolve(ls, iterations - done, done), range_slices(ls)
+
+
+def resumed_slices(init_level_set, slices, earlier=None):
+    """Which of the `slices` of the 2D modes resume from `init_level_set`.
+
+    Those where it is not empty, or, if it is an earlier result whose range
+    plane gave the `earlier` slices, only those that had the same seed then:
+    the others did not evolve as they will now, and run from scratch.
+    """
+    if init_level_set is None:
+        return np.zeros(len(slices), dtype=bool)
+    seeds = None if earlier is None else dict(earlier)
+    return np.array([init_level_set[row].any() and (seeds is None or seeds.get(row) == column)
+                     for row, column in slices], dtype=bool)
+
+
+# Memory the edge maps of the last volumes may keep, in bytes.
+EDGE_CACHE_BYTES = 2 * 1024 ** 3
+
+
+def edge_map(img, alpha=100.0, sigma=5.0):
+    """Edge-stopping image of GAC for `img` and its gradient, in single
+    precision."""
+    # The gradient magnitude of integer volumes stays truncated to integers,
+    # as it has always been, and the thresholds used with them rely on it
+    gimage = inverse_gaussian_gradient(img, alpha, sigma, dtype=np.float32)
+    return gimage, np.gradient(gimage)
+
+
+def box_contains(outer, box):
+    """Whether the box `box` is inside the box `outer`."""
+    return all(o.start <= b.start and b.stop <= o.stop for o, b in zip(outer, box))
+
+
+class EdgeMap(object):
+
+    def __init__(self, img, alpha=100.0, sigma=5.0):
+        """Edge map of `img` and its gradient, as `edge_map` gives them,
+        only computed on the parts of the volume the snakes evolve in.
+
+        `get` returns them as arrays of the size of `img` that hold them at
+        least in the box it is given. A box that is not inside one computed
+        before is computed with the halo of the filter, again over the boxes
+        it contains, e.g. the previous box of a region of interest that grew,
+        so a snake in a region of interest only pays for the region. It is
+        safe to use from several threads.
+        """
+        self.img = img
+        self.alpha = alpha
+        self.sigma = sigma
+        self.nbytes = img.size * np.dtype(np.float32).itemsize * (1 + img.ndim)
+        self.gimage = None
+        self.dimage = None
+        self.boxes = []
+        self.lock = threading.Lock()
+
+    def get(self, box=None):
+        """Edge map and gradient holding them in the box `box` of the volume,
+        whose missing trailing axes are whole, or everywhere if it is None."""
+        shape = self.img.shape
+        box = tuple(box or ()) + (slice(None),) * (len(shape) - len(box or ()))
+        box = tuple(slice(*s.indices(n)[:2]) for s, n in zip(box, shape))
+        with self.lock:
+            if any(box_contains(b, box) for b in self.boxes):
+                return self.gimage, self.dimage
+
+            if box == tuple(slice(0, n) for n in shape):
+                self.gimage, self.dimage = edge_map(self.img, self.alpha, self.sigma)
+            else:
+                if self.gimage is None:
+                    # Only the pages of the boxes computed are ever allocated
+                    self.gimage = np.empty(shape, dtype=np.float32)
+                    self.dimage = [np.empty(shape, dtype=np.float32) for _ in shape]
+                # The gradient needs the edge map a voxel around the box
+                outer = grow_roi_box(box, 1, shape)
+                inner = tuple(slice(b.start - o.start, b.stop - o.start)
+                              for b, o in zip(box, outer))
+                gimage = inverse_gaussian_gradient(self.img, self.alpha, self.sigma,
+                                                   box=outer, dtype=np.float32)
+                self.gimage[box] = gimage[inner]
+                for d, part in zip(self.dimage, np.gradient(gimage)):
+                    d[box] = part[inner]
+            self.boxes = [b for b in self.boxes if not box_contains(box, b)] + [box]
+            return self.gimage, self.dimage
+
+
+class EdgeCache(object):
+
+    def __init__(self, max_bytes=EDGE_CACHE_BYTES):
+        """Edge maps of the last volumes segmented with GAC.
+
+        Entries are identified by a key given by the caller, which must change
+        when the volume does, together with the parameters of the edge map.
+        They are `EdgeMap`s, which keep the parts of the edge map computed
+        for every run, but count for their whole size. The least recently
+        used ones are dropped when they need more than `max_bytes`.
+        """
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.nbytes = 0
+
+    def get(self, key, img, alpha=100.0, sigma=5.0):
+        """`EdgeMap` of `img`, the volume identified by `key`."""
+        key = (key, img.shape, alpha, sigma)
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.entries.move_to_end(key)
+            return entry
+
+        entry = EdgeMap(img, alpha, sigma)
+        if entry.nbytes <= self.max_bytes:
+            while self.nbytes + entry.nbytes > self.max_bytes:
+                self.nbytes -= self.entries.popitem(last=False)[1].nbytes
+            self.entries[key] = entry
+            self.nbytes += entry.nbytes
+        return entry
+
+
+class Progress(object):
+
+    def __init__(self, callback):
+        """Progress of a segmentation, reported to `callback` as the fraction
+        of the iterations it is expected to run that have been run.
+
+        The modes announce the iterations they expect with `expect` as soon as
+        they know them, correcting them later if needed, and the iterations of
+        every run of the snakes are counted with `run`. The fraction is an
+        estimate, as the snakes stop early and the slices of the 2D modes are
+        only known after their first run, but it is only reported when it
+        grows. It is safe to use from several threads.
+        """
+        self.callback = callback
+        self.expected = 0
+        self.done = 0
+        self.reported = 0.0
+        self.lock = threading.Lock()
+
+    def expect(self, iterations):
+        """Add `iterations`, which may be negative, to the expected ones."""
+        with self.lock:
+            self.expected += iterations
+        self.advance(0)
+
+    def advance(self, iterations):
+        """Count `iterations` more as run."""
+        with self.lock:
+            self.done += iterations
+            fraction = min(self.done / float(max(self.expected, 1)), 1.0)
+            if fraction <= self.reported:
+                return
+            self.reported = fraction
+        self.callback(fraction)
+
+    def run(self, iterations):
+        """Count the iterations of a run of the snakes of `iterations`.
+
+        Returns the `profile` callback to pass to the snakes, and a function
+        to call when the run ends, which counts the iterations it skipped by
+        stopping early.
+        """
+        counted = [0]
+
+        def profile(record):
+            if counted[0] < iterations:
+                counted[0] += 1
+                self.advance(1)
+
+        def finish():
+            self.advance(iterations - counted[0])
+
+        return profile, finish
+
+
+def live_callback(live, box):
+    """`iter_callback` of the snakes passing the level set of `box` to
+    `live`, or None without `live`."""
+    if live is None:
+        return None
+
+    def callback(u):
+        live(box, u)
+    return callback
+
+
+def acwe(image, init_ls, iterations, smoothing, roi=False, workspace=None,
+         progress=None, live=None, done=0):
+    """Evolve `init_ls` on `image` with MorphACWE. `done` iterations of the
+    same evolution already led to `init_ls`, so the result is the one of
+    running them all at once."""
+    profile = None
+    if progress is not None:
+        profile, finish = progress.run(iterations)
+
+    def evolve(box, init_ls, iterations, start=0, outside=None):
+        return ms.morphological_chan_vese(image[box], iterations=iterations,
+                                          init_level_set=init_ls,
+                                          smoothing=smoothing, lambda1=2, lambda2=1,
+                                          narrow_band=True, workspace=workspace,
+                                          outside=outside, tolerance=0,
+                                          window=CONVERGENCE_WINDOW, return_info=True,
+                                          profile=profile,
+                                          iter_callback=live_callback(live, box),
+                                          phase=(done + start) * smoothing)
+
+    if not roi:
+        ls = evolve(Ellipsis, init_ls, iterations)[0]
+    else:
+        # The rest of the image still belongs to the outside region
+        if np.issubdtype(image.dtype, np.integer):
+            total = image.sum(dtype=np.int64)
+        else:
+            total = image.sum(dtype=np.float64)
+
+        def evolve_box(box, init_ls, iterations, start):
+            crop = image[box]
+            outside = (total - crop.sum(dtype=total.dtype), image.size - crop.size)
+            return evolve(box, init_ls, iterations, start, outside)
+
+        ls = evolve_roi(evolve_box, init_ls, iterations)
+
+    if progress is not None:
+        finish()
+    return ls
+
+
+def gac(gimage, init_ls, iterations, smoothing, balloon, threshold, roi=False,
+        workspace=None, dimage=None, progress=None, live=None, done=0):
+    """Evolve `init_ls` on the edge map `gimage` with MorphGAC, after `done`
+    iterations as in `acwe`. `gimage` may also be an `EdgeMap`, which then
+    gives the edge map and its gradient on the region evolved."""
+    profile = None
+    if progress is not None:
+        profile, finish = progress.run(iterations)
+
+    def evolve(box, init_ls, iterations, start=0):
+        edge_image, gradient = gimage, dimage
+        if isinstance(gimage, EdgeMap):
+            edge_image, gradient = gimage.get(None if box is Ellipsis else box)
+        if gradient is not None:
+            gradient = [d[box] for d in gradient]
+        return ms.morphological_geodesic_active_contour(edge_image[box], iterations=iterations,
+                                                        init_level_set=init_ls,
+                                                        smoothing=smoothing, balloon=balloon, threshold=threshold,
+                                                        narrow_band=True, workspace=workspace,
+                                                        tolerance=0, window=CONVERGENCE_WINDOW,
+                                                        return_info=True, gradient=gradient,
+                                                        profile=profile,
+                                                        iter_callback=live_callback(live, box),
+                                                        phase=(done + start) * smoothing)
+
+    if not roi:
+        ls = evolve(Ellipsis, init_ls, iterations)[0]
+    else:
+        ls = evolve_roi(evolve, init_ls, iterations)
+
+    if progress is not None:
+        finish()
+    return ls
+
+
+def pyramid_iterations(iterations, levels=PYRAMID_LEVELS, refine=PYRAMID_REFINE):
+    """Number of iterations `evolve_pyramid` runs over all its levels."""
+    return iterations + levels * min(refine, iterations)
+
+
+def acwe3d(img, coord, iterations, smoothing, roi=False, pyramid=False,
+           preview=None, progress=None, live=None, init_level_set=None, done=0):
     print('Running: snake_3d (MorphACWE)...')
 
+    if init_level_set is not None:
+        # An earlier result only needs the remaining iterations, at full
+        # resolution
+        if progress is not None:
+            progress.expect(iterations - done)
+        return acwe(img, init_level_set, iterations - done, smoothing, roi,
+                    progress=progress, live=live, done=done)
+
+    if pyramid:
+        center = (coord[2], coord[1], coord[0])
+        levels = pyramid_levels(img, center, 5)
+        if progress is not None:
+            progress.expect(pyramid_iterations(iterations, levels))
+
+        def evolve(image, init_ls, iterations):
+            # Only the full resolution is shown live
+            return acwe(image, init_ls, iterations, smoothing, roi, progress=progress,
+                        live=live if image is img else None)
+        return evolve_pyramid(evolve, img, center, 5, iterations, levels,
+                              preview=preview)
+
+    if progress is not None:
+        progress.expect(iterations)
     init_ls = ms.circle_level_set(img.shape, (coord[2], coord[1], coord[0]), 5)
 
-    ls = ms.morphological_chan_vese(img, iterations=iterations,
-                                    init_level_set=init_ls,
-                                    smoothing=smoothing, lambda1=2, lambda2=1)
+    ls = acwe(img, init_ls, iterations, smoothing, roi, progress=progress, live=live)
     return ls
 
 
 
-def acwe2d(img, coord, iterations, smoothing):
+def acwe2d(img, coord, iterations, smoothing, roi=False, workers=WORKERS,
+           batched=False, progress=None, live=None, init_level_set=None, done=0):
     print('Running: snake_2d (MorphACWE)...')
 
+    # Every slice may have to be segmented until the first run tells which
+    if progress is not None:
+        progress.expect(iterations + len(img) * iterations)
+
     range_img = img[:, :, coord[0]]
     range_init_ls = ms.circle_level_set(
         range_img.shape, (coord[2], coord[1]), 5)
-    range_ls = ms.morphological_chan_vese(range_img, iterations=iterations,
-                                            init_level_set=range_init_ls,
-                                            smoothing=smoothing, lambda1=2, lambda2=1)
+    # An earlier result is only resumed on the slices it has the same seed
+    # on, which the range plane tells after as many iterations
+    def evolve(init_ls, iterations, done):
+        return acwe(range_img, init_ls, iterations, smoothing, roi, progress=progress,
+                    done=done)
+    range_ls, earlier = evolve_range(evolve, range_init_ls, iterations,
+                                     0 if init_level_set is None else done)
     # save_img(range_img, range_ls, "acwe_2d_y_slice")
 
 
-    slices = []
-    i = 0
-    for row in range_ls:
-        for x in row:
-            if x == 1:
-                slices.append([i, middle_of_line(row)])
-                break
-        i += 1
+    slices = range_slices(range_ls)
+
+    if not slices:
+        # The seed is not inside anything the snake could find
+        return np.zeros(img.shape, dtype=np.uint8)
 
     middle = int((slices[-1][0] + slices[0][0]) / 2)
     result = np.zeros(img.shape, dtype=np.uint8)
+    if progress is not None:
+        progress.expect(-(len(img) - len(slices)) * iterations)
 
-    for line in slices:
+    # The slices of an earlier result only run the remaining iterations
+    resumed = resumed_slices(init_level_set, slices, earlier)
+    if batched:
+        rows = np.array([line[0] for line in slices])
+        init_ls = slice_level_sets(img, slices, coord)
+        if resumed.any():
+            init_ls[resumed] = init_level_set[rows[resumed]] > 0
+        for group, start in ((~resumed, 0), (resumed, done)):
+            if group.any():
+                result[rows[group]] = ms.morphological_chan_vese_stack(img[rows[group]], iterations - start,
+                                                                       init_level_sets=init_ls[group],
+                                                                       smoothing=smoothing, lambda1=2, lambda2=1,
+                                                                       narrow_band=True, phase=start * smoothing)
+        if progress is not None:
+            progress.expect(-done * np.count_nonzero(resumed))
+            progress.advance(len(rows) * iterations - done * np.count_nonzero(resumed))
+        if live is not None:
+            live((rows,), result[rows])
+        return result
+
+    resumed = set(line[0] for line, r in zip(slices, resumed) if r)
+
+    def segment_slice(line, workspace):
         image_part = img[line[0]]
         init_ls = ms.circle_level_set(
             image_part.shape, (line[1], coord[0]), 5)
-        ls = ms.morphological_chan_vese(image_part, iterations=iterations,
-                                        init_level_set=init_ls,
-                                        smoothing=smoothing, lambda1=2, lambda2=1)
+        start = 0
+        if line[0] in resumed:
+            init_ls, start = init_level_set[line[0]], done
+            if progress is not None:
+                progress.expect(-done)
+        ls = acwe(image_part, init_ls, iterations - start, smoothing, roi, workspace=workspace,
+                  progress=progress, done=start)
         result[line[0]] = ls
+        if live is not None:
+            live((line[0],), ls)
         # if i == middle:
         #     save_img(image_part, ls, "acwe_2d_slice")
 
+    for_each_slice(segment_slice, slices, workers)
     return result
 
 
-def acwe2d_prev(img, coord, iterations, smoothing):
+def acwe2d_prev(img, coord, iterations, smoothing, roi=False, progress=None,
+                live=None, workers=WORKERS, adaptive=False, init_level_set=None,
+                done=0):
+    """Segment the middle slice of the object, then every other slice from
+    the result of its neighbour towards the middle.
+
+    The slices above and below the middle are propagated by two threads if
+    `workers` allows it. Every propagated slice runs `iterations // 4`
+    iterations or, if `adaptive`, as many as `warm_start_budget` gives from
+    the change of the previous slice, starting from `iterations // 4`. Only
+    the middle slice resumes from `init_level_set`, if it was the middle one
+    with the same seed `done` iterations in, as the propagation is cheap
+    enough to run again.
+    """
     print('Running: snake_2d_prev (MorphACWE)...')
 
+    # Buffers shared by the evolutions of all the slices
+    workspace = ms.Workspace()
+
+    # Every slice may have to be segmented until the first run tells which
+    if progress is not None:
+        progress.expect(2 * iterations + len(img) * (iterations // 4))
+
     range_img = img[:, :, coord[0]]
     range_init_ls = ms.circle_level_set(
         range_img.shape, (coord[2], coord[1]), 5)
-    range_ls = ms.morphological_chan_vese(range_img, iterations=iterations,
-                                          init_level_set=range_init_ls,
-                                          smoothing=smoothing, lambda1=2, lambda2=1)
+    # The middle slice is only resumed if it was the middle one, with the
+    # same seed, of the earlier result, which the range plane tells after as
+    # many iterations
+    def evolve(init_ls, iterations, done):
+        return acwe(range_img, init_ls, iterations, smoothing, roi, workspace=workspace,
+                    progress=progress, done=done)
+    range_ls, earlier = evolve_range(evolve, range_init_ls, iterations,
+                                     0 if init_level_set is None else done)
     # save_img(range_img, range_ls, "acwe_2d_prev_y_slice")
 
-    slices = []
-    i = 0
-    for row in range_ls:
-        for x in row:
-            if x == 1:
-                slices.append([i, middle_of_line(row)])
-                break
-        i += 1
+    slices = range_slices(range_ls)
+
+    if not slices:
+        # The seed is not inside anything the snake could find
+        return np.zeros(img.shape, dtype=np.uint8)
 
     middle = int((slices[-1][0] + slices[0][0]) / 2)
     middle_index = int(len(slices) / 2)
+    if progress is not None:
+        runs = len(slices) - middle_index - 1 + max(middle_index - 1, 0)
+        progress.expect(-(len(img) - runs) * (iterations // 4))
 
     middle_img = img[slices[middle_index][0]]
     init_ls = ms.circle_level_set(
         middle_img.shape, (slices[middle_index][1], coord[0]), 5)
-    middle_ls = ms.morphological_chan_vese(middle_img, iterations=iterations,
-                                         init_level_set=init_ls,
-                                         smoothing=smoothing, lambda1=2, lambda2=1)
+    start = 0
+    if resumed_slices(init_level_set, [slices[middle_index]],
+                      earlier and [earlier[int(len(earlier) / 2)]])[0]:
+        init_ls, start = init_level_set[slices[middle_index][0]], done
+        if progress is not None:
+            progress.expect(-done)
+    middle_ls = acwe(middle_img, init_ls, iterations - start, smoothing, roi, workspace=workspace,
+                     progress=progress, done=start)
 
     result = np.zeros(img.shape, dtype=np.uint8)
     result[slices[middle_index][0]] = middle_ls
+    if live is not None:
+        live((slices[middle_index][0],), middle_ls)
     # save_img(middle_img, middle_ls, "acwe_2d_prev_slice")
 
-    prev_ls = middle_ls
-    for i in range(middle_index + 1, len(slices)):
-        line = slices[i]
-        image_part = img[line[0]]
-        ls = ms.morphological_chan_vese(image_part, iterations=(iterations // 4),
-                                        init_level_set=prev_ls,
-                                        smoothing=smoothing, lambda1=2, lambda2=1)
-        prev_ls = ls
-        result[line[0]] = ls
+    def propagate(indices, workspace):
+        prev_ls = middle_ls
+        budget = iterations // 4
+        for i in indices:
+            line = slices[i]
+            image_part = img[line[0]]
+            if progress is not None and budget != iterations // 4:
+                progress.expect(budget - iterations // 4)
+            ls = acwe(image_part, prev_ls, budget, smoothing, roi, workspace=workspace,
+                      progress=progress)
+            if adaptive:
+                budget = warm_start_budget(prev_ls, ls, iterations)
+            prev_ls = ls
+            result[line[0]] = ls
+            if live is not None:
+                live((line[0],), ls)
 
-    prev_ls = middle_ls
-    for i in range(middle_index - 1, 0, -1):
-        line = slices[i]
-        image_part = img[line[0]]
-        ls = ms.morphological_chan_vese(image_part, iterations=(iterations // 4),
-                                        init_level_set=prev_ls,
-                                        smoothing=smoothing, lambda1=2, lambda2=1)
-        prev_ls = ls
-        result[line[0]] = ls
+    # Both directions only depend on the middle slice
+    up = range(middle_index + 1, len(slices))
+    down = range(middle_index - 1, 0, -1)
+    if workers > 1 and len(up) and len(down):
+        with ThreadPool(2) as pool:
+            pool.starmap(propagate, [(up, workspace), (down, ms.Workspace())])
+    else:
+        propagate(up, workspace)
+        propagate(down, workspace)
 
     return result
 
 
-def gac3d(img, coord, iterations, smoothing, balloon, threshold):
+def gac3d(img, coord, iterations, smoothing, balloon, threshold, roi=False,
+          pyramid=False, preview=None, edges=EdgeMap, progress=None, live=None,
+          init_level_set=None, done=0):
     print('Running: snake_3d (MorphGAC)...')
 
+    # With a region of interest, the edge map is only computed on the region
+    edge = edges(img)
+    gimage, dimage = (edge, None) if roi else edge.get()
+    if init_level_set is not None:
+        # An earlier result only needs the remaining iterations, at full
+        # resolution
+        if progress is not None:
+            progress.expect(iterations - done)
+        return gac(gimage, init_level_set, iterations - done, smoothing, balloon, threshold,
+                   roi, dimage=dimage, progress=progress, live=live, done=done)
+
+    if pyramid:
+        # The coarse levels need the edge map of the whole volume
+        gimage, dimage = edge.get()
+        center = (coord[2], coord[1], coord[0])
+        # The object is told by the volume, as the edge map blurs its border
+        levels = pyramid_levels(img, center, 5)
+        if progress is not None:
+            progress.expect(pyramid_iterations(iterations, levels))
+
+        def evolve(level_gimage, init_ls, iterations):
+            # The gradient is only known, and the level set only shown live,
+            # at full resolution
+            full = level_gimage is gimage
+            return gac(level_gimage, init_ls, iterations, smoothing, balloon, threshold, roi,
+                       dimage=dimage if full else None, progress=progress,
+                       live=live if full else None)
+        return evolve_pyramid(evolve, gimage, center, 5, iterations, levels,
+                              preview=preview)
+
+    if progress is not None:
+        progress.expect(iterations)
     init_ls = ms.circle_level_set(img.shape, (coord[2], coord[1], coord[0]), 5)
 
-    gimage = inverse_gaussian_gradient(img)
-    ls = ms.morphological_geodesic_active_contour(gimage, iterations=iterations,
-                                                    init_level_set=init_ls,
-                                                    smoothing=smoothing, balloon=balloon, threshold=threshold)
+    ls = gac(gimage, init_ls, iterations, smoothing, balloon, threshold, roi,
+             dimage=dimage, progress=progress, live=live)
     return ls
 
-def gac2d(img, coord, iterations, smoothing, balloon, threshold):
+def gac2d(img, coord, iterations, smoothing, balloon, threshold, roi=False,
+          workers=WORKERS, batched=False, edges=EdgeMap, progress=None,
+          live=None, init_level_set=None, done=0):
     print('Running: snake_2d (MorphGAC)...')
 
+    # Every slice may have to be segmented until the first run tells which
+    if progress is not None:
+        progress.expect(iterations + len(img) * iterations)
+
+    # The slices are segmented on slices of the edge map of the volume, which
+    # with a region of interest is only computed on the range plane and the
+    # slices it crosses
+    edge = edges(img)
+    if roi:
+        gimage, dimage = edge.get((slice(None), slice(None), slice(coord[0], coord[0] + 1)))
+    else:
+        gimage, dimage = edge.get()
+
     range_img = img[:, :, coord[0]]
     range_init_ls = ms.circle_level_set(
         range_img.shape, (coord[2], coord[1]), 5)
-    range_gimage = inverse_gaussian_gradient(range_img)
-    range_ls = ms.morphological_geodesic_active_contour(range_gimage, iterations=iterations,
-                                                            init_level_set=range_init_ls,
-                                                            smoothing=smoothing, balloon=balloon, threshold=threshold)
+    range_gimage = gimage[:, :, coord[0]]
+    range_dimage = [d[:, :, coord[0]] for d in dimage[:2]]
+    # An earlier result is only resumed on the slices it has the same seed
+    # on, which the range plane tells after as many iterations
+    def evolve(init_ls, iterations, done):
+        return gac(range_gimage, init_ls, iterations, smoothing, balloon, threshold, roi,
+                   dimage=range_dimage, progress=progress, done=done)
+    range_ls, earlier = evolve_range(evolve, range_init_ls, iterations,
+                                     0 if init_level_set is None else done)
     # save_img(range_img, range_ls, "gac_2d_y_slice")
 
-    slices = []
-    i = 0
-    for row in range_ls:
-        for x in row:
-            if x == 1:
-                slices.append([i, middle_of_line(row)])
-                break
-        i += 1
+    slices = range_slices(range_ls)
+
+    if not slices:
+        # The seed is not inside anything the snake could find
+        return np.zeros(img.shape, dtype=np.uint8)
 
     middle = int((slices[-1][0] + slices[0][0]) / 2)
     result = np.zeros(img.shape, dtype=np.uint8)
-    for line in slices:
+    if progress is not None:
+        progress.expect(-(len(img) - len(slices)) * iterations)
+    if roi:
+        gimage, dimage = edge.get((slice(slices[0][0], slices[-1][0] + 1),))
+
+    # The slices of an earlier result only run the remaining iterations
+    resumed = resumed_slices(init_level_set, slices, earlier)
+    if batched:
+        rows = np.array([line[0] for line in slices])
+        init_ls = slice_level_sets(img, slices, coord)
+        if resumed.any():
+            init_ls[resumed] = init_level_set[rows[resumed]] > 0
+        for group, start in ((~resumed, 0), (resumed, done)):
+            if group.any():
+                group_rows = rows[group]
+                result[group_rows] = ms.morphological_geodesic_active_contour_stack(gimage[group_rows], iterations - start,
+                                                                                    init_level_sets=init_ls[group],
+                                                                                    smoothing=smoothing, balloon=balloon, threshold=threshold,
+                                                                                    narrow_band=True,
+                                                                                    gradient=[d[group_rows] for d in dimage[1:]],
+                                                                                    phase=start * smoothing)
+        if progress is not None:
+            progress.expect(-done * np.count_nonzero(resumed))
+            progress.advance(len(rows) * iterations - done * np.count_nonzero(resumed))
+        if live is not None:
+            live((rows,), result[rows])
+        return result
+
+    resumed = set(line[0] for line, r in zip(slices, resumed) if r)
+
+    def segment_slice(line, workspace):
         image_part = img[line[0]]
         init_ls = ms.circle_level_set(
             image_part.shape, (line[1], coord[0]), 5)
+        start = 0
+        if line[0] in resumed:
+            init_ls, start = init_level_set[line[0]], done
+            if progress is not None:
+                progress.expect(-done)
 
-        gimage = inverse_gaussian_gradient(image_part)
-        ls = ms.morphological_geodesic_active_contour(gimage, iterations=iterations,
-                                                        init_level_set=init_ls,
-                                                        smoothing=smoothing, balloon=balloon, threshold=threshold)
+        ls = gac(gimage[line[0]], init_ls, iterations - start, smoothing, balloon, threshold, roi,
+                 workspace=workspace, dimage=[d[line[0]] for d in dimage[1:]],
+                 progress=progress, done=start)
         result[line[0]] = ls
+        if live is not None:
+            live((line[0],), ls)
         # if i == middle:
         #     save_img(image_part, ls, "gac_2d_slice")
 
-
+    for_each_slice(segment_slice, slices, workers)
     return result
     
 
 
+def segment(mode, img, coord, iterations, smoothing, threshold, balloon,
+            roi=False, workers=WORKERS, batched=False, pyramid=False,
+            preview=None, edges=EdgeMap, progress=None, live=None,
+            adaptive=False, init_level_set=None, done=0):
+    """Run the segmentation `mode` around the seed `coord`.
+
+    `progress`, if given, is called from time to time with the estimated
+    fraction of the segmentation that is done, possibly from several threads.
+    `live`, if given, is called as `live(index, ls)` whenever a part of the
+    result changes, with `ls` the new level set of `img[index]`: after every
+    iteration of the 3D modes, on the region they evolve at full resolution,
+    and after every slice of the 2D modes. `adaptive` adapts the iterations of
+    every slice of acwe2d_prev to the change of the previous one.
+
+    With `init_level_set`, the segmentation starts from that level set of the
+    whole volume instead of a ball around the seed, e.g. an earlier result of
+    `done` of the `iterations`, and runs the iterations that remain: the 3D
+    modes at full resolution, and the 2D modes on the slices where it is not
+    empty, the others starting from scratch. The range plane of the 2D modes
+    runs all the iterations again, and those slices are only the ones whose
+    seed it already gave after `done` of them, as the seed of the others
+    changed since.
+    """
+    if progress is not None:
+        progress = Progress(progress)
+    if init_level_set is not None and not np.any(init_level_set):
+        # Nothing to resume from
+        init_level_set = None
+    if init_level_set is not None:
+        done = min(done, iterations)
+
+    if mode == 0:
+        return acwe3d(img, coord, iterations, smoothing, roi, pyramid, preview,
+                      progress, live, init_level_set, done)
+    elif mode == 1:
+        return acwe2d(img, coord, iterations, smoothing, roi, workers, batched,
+                      progress, live, init_level_set, done)
+    elif mode == 2:
+        return gac3d(img, coord, iterations, smoothing, balloon, threshold, roi,
+                     pyramid, preview, edges, progress, live, init_level_set,
+                     done)
+    elif mode == 3:
+        return gac2d(img, coord, iterations, smoothing, balloon, threshold, roi,
+                     workers, batched, edges, progress, live, init_level_set,
+                     done)
+    elif mode == 4:
+        return acwe2d_prev(img, coord, iterations, smoothing, roi, progress,
+                           live, workers, adaptive, init_level_set, done)
+    raise ValueError("Unknown mode: %d" % mode)
+
+
+def segment_seeds(mode, img, coords, iterations, smoothing, threshold, balloon,
+                  roi=False, workers=WORKERS, batched=False, pyramid=False,
+                  edges=EdgeMap, progress=None, adaptive=False,
+                  init_level_set=None, done=0):
+    """Segment the object around every seed of `coords` with `segment`.
+
+    Returns a label volume where the object of the n-th seed is labelled n + 1;
+    a voxel in the objects of several seeds keeps the label of the first one.
+    The seeds are segmented in parallel by `workers` threads, and the GAC modes
+    share one edge map of the volume. `progress` is called with the average of
+    the progress of the seeds. `init_level_set` is a label volume as returned,
+    every seed resuming from its own label. As the voxels of several objects
+    only keep one label, a seed whose object overlapped one of a previous
+    seed resumes from less than it had, and only gives the result of a full
+    run where the objects do not meet.
+    """
+    if len(coords) > 255:
+        raise ValueError("At most 255 seeds can be segmented at once")
+
+    if mode in (2, 3):
+        shared = edges(img)
+
+        def edges(img):
+            return shared
+
+    fractions = [0.0] * len(coords)
+    lock = threading.Lock()
+
+    def segment_seed(seed):
+        i, coord = seed
+        seed_progress = None
+        if progress is not None:
+            def seed_progress(fraction):
+                with lock:
+                    fractions[i] = fraction
+                    total = sum(fractions) / len(fractions)
+                progress(total)
+
+        # The seeds already keep the workers busy, so the slices of the 2D
+        # modes are segmented one after another
+        init_ls = None
+        if init_level_set is not None:
+            init_ls = init_level_set == i + 1
+
+        return segment(mode, img, coord, iterations, smoothing, threshold,
+                       balloon, roi, 1, batched, pyramid, None, edges,
+                       seed_progress, None, adaptive, init_ls, done)
+
+    labels = np.zeros(img.shape, dtype=np.uint8)
+    with ThreadPool(max(min(workers, len(coords)), 1)) as pool:
+        for label, ls in enumerate(pool.imap(segment_seed, enumerate(coords)), 1):
+            labels[(ls > 0) & (labels == 0)] = label
+    return labels
+
+
+def compact_mask(ls):
+    """Compact encoding of the result `ls`, a level set, label volume or
+    planes of bits, whose size follows the object rather than the volume.
+
+    Returns a dictionary with the `shape` of `ls`, the `box` around its
+    non-zero voxels, as a [start, stop] pair per axis, and the `data` of `ls`
+    in the box as uint8 bytes in C order, bit-packed with np.packbits if
+    `packed`, i.e. if it only holds zeros and ones. The box of an empty `ls`
+    is empty.
+    """
+    if np.any(ls):
+        box = roi_box(ls, 0)
+    else:
+        box = tuple(slice(0, 0) for _ in ls.shape)
+    crop = np.ascontiguousarray(ls[box], dtype=np.uint8)
+    packed = bool(crop.size == 0 or crop.max() <= 1)
+    data = np.packbits(crop) if packed else crop
+    return {'shape': list(ls.shape),
+            'box': [[int(s.start), int(s.stop)] for s in box],
+            'packed': packed, 'data': data.tobytes()}
+
+
+# Parameters a sweep varies, in the order of its variants
+SWEEP_PARAMETERS = ('iterations', 'smoothing', 'threshold', 'balloon')
+
+
+def sweep_variants(grid):
+    """Every combination of the values `grid` gives to each of
+    SWEEP_PARAMETERS, as dictionaries, the last parameter varying fastest."""
+    missing = [name for name in SWEEP_PARAMETERS if name not in grid]
+    if missing:
+        raise ValueError("The sweep needs values of %s" % ', '.join(missing))
+    values = [list(grid[name]) for name in SWEEP_PARAMETERS]
+    return [dict(zip(SWEEP_PARAMETERS, combination))
+            for combination in itertools.product(*values)]
+
+
+def mask_planes(shape, count):
+    """Empty planes of bits for `count` masks of `shape`, as `sweep` returns
+    them."""
+    return np.zeros(((count + 7) // 8,) + tuple(shape), dtype=np.uint8)
+
+
+def sweep(mode, img, coord, grid, roi=False, workers=WORKERS, batched=False,
+          pyramid=False, edges=EdgeMap, progress=None, adaptive=False):
+    """Segment around the seed `coord` with every combination of the
+    parameters of `grid`, as given by `sweep_variants`.
+
+    Returns the variants and their masks, packed as bits: variant i is bit
+    i % 8 of the plane i // 8 of the returned uint8 array.
+
+    The work the variants have in common is only done once. The GAC modes
+    share one edge map, ACWE ignores the threshold and the balloon, and the
+    variants that only differ by their iterations are the steps of a single
+    evolution, each resuming from the previous one as `segment` does with
+    `init_level_set`, except in pyramid mode; the 2D modes run the slices
+    whose seed changed on the way from scratch. Those evolutions run in
+    parallel, sharing the `workers` threads, and `progress` is called with
+    the fraction of all their iterations that is done.
+    """
+    variants = sweep_variants(grid)
+    planes = mask_planes(img.shape, len(variants))
+
+    if mode in (2, 3):
+        shared = edges(img)
+
+        def edges(img):
+            return shared
+
+    # Variants giving the same result but for their iterations
+    trajectories = OrderedDict()
+    for i, variant in enumerate(variants):
+        key = (variant['smoothing'],)
+        if mode in (2, 3):
+            key += (variant['threshold'], variant['balloon'])
+        trajectories.setdefault(key, []).append(i)
+    trajectories = [(indices, sorted(set(variants[i]['iterations'] for i in indices)))
+                    for indices in trajectories.values()]
+
+    # Every run of an evolution counts for the iterations it runs
+    weights = []
+    for _, steps in trajectories:
+        weights.extend(max(b - a, 1) for a, b in zip([0] + steps, steps))
+    if pyramid:
+        weights = [max(b, 1) for _, steps in trajectories for b in steps]
+    first_runs = np.cumsum([0] + [len(steps) for _, steps in trajectories])
+    fractions = [0.0] * len(weights)
+    lock = threading.Lock()
+
+    def run_progress(run):
+        if progress is None:
+            return None
+
+        def report(fraction):
+            with lock:
+                fractions[run] = fraction
+                total = sum(w * f for w, f in zip(weights, fractions)) / float(sum(weights))
+            progress(total)
+        return report
+
+    threads = max(min(workers, len(trajectories)), 1)
+
+    def run_trajectory(job):
+        run, (indices, steps) = job
+        variant = variants[indices[0]]
+        ls = None
+        done = 0
+        for iterations in steps:
+            ls = segment(mode, img, coord, iterations, variant['smoothing'],
+                         variant['threshold'], variant['balloon'], roi,
+                         max(workers // threads, 1), batched, pyramid, None,
+                         edges, run_progress(run), None, adaptive,
+                         None if pyramid else ls, done)
+            done = iterations
+            run += 1
+
+            mask = ls > 0
+            with lock:
+                for i in indices:
+                    if variants[i]['iterations'] == iterations:
+                        planes[i // 8][mask] |= np.uint8(1 << (i % 8))
+
+    with ThreadPool(threads) as pool:
+        pool.map(run_trajectory, zip(first_runs, trajectories))
+    return variants, planes
+
 if __name__ == '__main__':
 
     mode = int(sys.argv[1])
@@ -205,24 +1146,23 @@ if __name__ == '__main__':
     smoothing = int(sys.argv[3])
     threshold = float(sys.argv[4])
     balloon = int(sys.argv[5])
+    roi = len(sys.argv) > 6 and sys.argv[6] == '1'
+    workers = int(sys.argv[7]) if len(sys.argv) > 7 else WORKERS
+    batched = len(sys.argv) > 8 and sys.argv[8] == '1'
+    pyramid = len(sys.argv) > 9 and sys.argv[9] == '1'
 
     dir_path = os.path.dirname(os.path.realpath(__file__))
     img = np.load(dir_path + '/image.npy')
     coord = np.load(dir_path + '/coord.npy')
 
-    ls = []
     start = time.time()
-    if mode == 0:
-        ls = acwe3d(img, coord, iterations, smoothing)
-    elif mode == 1:
-        ls = acwe2d(img, coord, iterations, smoothing)
-    elif mode == 2:
-        ls = gac3d(img, coord, iterations, smoothing, balloon, threshold)
-    elif mode == 3:
-        ls = gac2d(img, coord, iterations, smoothing, balloon, threshold)
-    elif mode == 4:
-        ls = acwe2d_prev(img, coord, iterations, smoothing)
-    
+    if coord.ndim == 2:
+        # One seed per row, segmented together as a label volume
+        ls = segment_seeds(mode, img, coord.tolist(), iterations, smoothing,
+                           threshold, balloon, roi, workers, batched, pyramid)
+    else:
+        ls = segment(mode, img, coord, iterations, smoothing, threshold, balloon,
+                     roi, workers, batched, pyramid)
     end = time.time()
     print("Time: " + str(end - start) + " sec.")
 
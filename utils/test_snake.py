@@ -0,0 +1,304 @@
+"""Tests of the snakes against the dense evolution of morphsnakes.
+
+The narrow band, the packed level sets, the early stop, the stacks of slices,
+the regions of interest and the threads all promise the result of the plain
+evolution, which is what these tests check on small noisy phantoms:
+
+    python3 -m pytest utils
+"""
+import numpy as np
+import pytest
+
+import morphsnakes as ms
+import snake
+
+
+ITERATIONS = 12
+THRESHOLD = 0.3
+BALLOON = 1
+
+
+def phantom(shape, radius, seed=0):
+    """Noisy ball of `radius` voxels in the middle of a volume or image of
+    `shape`, and the [x, y, z] coordinate of its centre as the modes take it."""
+    grid = np.indices(shape)
+    center = [n // 2 for n in shape]
+    inside = sum((g - c) ** 2 for g, c in zip(grid, center)) < radius ** 2
+    rng = np.random.default_rng(seed)
+    img = (100 * inside + rng.normal(0, 20, shape)).astype(np.int16)
+    return img, center[::-1]
+
+
+@pytest.fixture(scope='module')
+def volume():
+    return phantom((24, 32, 32), 9)
+
+
+@pytest.fixture(scope='module')
+def growing():
+    # The range plane of the 2D modes still crosses new rows, with new seeds,
+    # after the first iterations
+    return phantom((40, 64, 64), 16, seed=3)
+
+
+def dense_acwe(image, init_ls, iterations, smoothing):
+    return ms.morphological_chan_vese(image, iterations, init_ls, smoothing,
+                                      lambda1=2, lambda2=1)
+
+
+def dense_gac(gimage, init_ls, iterations, smoothing):
+    return ms.morphological_geodesic_active_contour(
+        gimage, iterations, init_ls, smoothing, THRESHOLD, BALLOON)
+
+
+def dense_2d(evolve, img, coord, iterations, smoothing):
+    """Result of acwe2d or gac2d with the plain evolution `evolve` of the
+    slices of `img`, which is the volume or its edge map."""
+    range_img = img[:, :, coord[0]]
+    range_ls = evolve(range_img,
+                      ms.circle_level_set(range_img.shape, (coord[2], coord[1]), 5),
+                      iterations, smoothing)
+    result = np.zeros(img.shape, dtype=np.uint8)
+    for row in np.flatnonzero(range_ls.any(axis=1)):
+        init_ls = ms.circle_level_set(img.shape[1:],
+                                      (snake.middle_of_line(range_ls[row]), coord[0]), 5)
+        result[row] = evolve(img[row], init_ls, iterations, smoothing)
+    return result
+
+
+@pytest.mark.parametrize('shape', [(40, 40), (20, 24, 24)])
+@pytest.mark.parametrize('options', [
+    {'narrow_band': True},
+    {'packed': True},
+    {'tolerance': 0, 'window': 2},
+    {'narrow_band': True, 'tolerance': 0, 'window': 2},
+])
+def test_engines_match_dense(shape, options):
+    img, _ = phantom(shape, min(shape) // 3)
+    init_ls = ms.circle_level_set(shape, None, 4)
+    expected = ms.morphological_chan_vese(img, ITERATIONS, init_ls, 1, 2, 1)
+    result = ms.morphological_chan_vese(img, ITERATIONS, init_ls, 1, 2, 1, **options)
+    np.testing.assert_array_equal(result, expected)
+
+    gimage = snake.edge_map(img)[0]
+    expected = ms.morphological_geodesic_active_contour(
+        gimage, ITERATIONS, init_ls, 1, THRESHOLD, BALLOON)
+    result = ms.morphological_geodesic_active_contour(
+        gimage, ITERATIONS, init_ls, 1, THRESHOLD, BALLOON, **options)
+    np.testing.assert_array_equal(result, expected)
+
+
+def test_stacks_match_slices():
+    img, _ = phantom((6, 32, 32), 10)
+    init_ls = np.array([ms.circle_level_set(img.shape[1:], (16, 12 + i), 4)
+                        for i in range(len(img))])
+    gimage = snake.edge_map(img)[0]
+    for narrow_band in (False, True):
+        result = ms.morphological_chan_vese_stack(img, ITERATIONS, init_ls, 2, 2, 1,
+                                                  narrow_band=narrow_band)
+        for i in range(len(img)):
+            np.testing.assert_array_equal(result[i], dense_acwe(img[i], init_ls[i], ITERATIONS, 2))
+
+        result = ms.morphological_geodesic_active_contour_stack(
+            gimage, ITERATIONS, init_ls, 2, THRESHOLD, BALLOON, narrow_band=narrow_band)
+        for i in range(len(img)):
+            np.testing.assert_array_equal(result[i], dense_gac(gimage[i], init_ls[i], ITERATIONS, 2))
+
+
+@pytest.mark.parametrize('roi', [False, True])
+@pytest.mark.parametrize('mode', [0, 2])
+def test_3d_modes_match_dense(volume, mode, roi):
+    img, coord = volume
+    init_ls = ms.circle_level_set(img.shape, coord[::-1], 5)
+    if mode == 0:
+        expected = dense_acwe(img, init_ls, ITERATIONS, 1)
+    else:
+        expected = dense_gac(snake.edge_map(img)[0], init_ls, ITERATIONS, 1)
+    result = snake.segment(mode, img, coord, ITERATIONS, 1, THRESHOLD, BALLOON, roi)
+    np.testing.assert_array_equal(result > 0, expected > 0)
+
+
+@pytest.mark.parametrize('dtype', [np.int16, np.float32])
+def test_edge_map_parts_match_whole(dtype):
+    img = phantom((24, 32, 32), 9)[0].astype(dtype)
+    gimage, dimage = snake.edge_map(img)
+    edges = snake.EdgeMap(img)
+    for box in [(slice(8, 16), slice(4, 20), slice(10, 30)),
+                (slice(4, 20), slice(0, 24), slice(6, 32))]:
+        part, dpart = edges.get(box)
+        np.testing.assert_array_equal(part[box], gimage[box])
+        for d, expected in zip(dpart, dimage):
+            np.testing.assert_array_equal(d[box], expected[box])
+    # The second box contains the first
+    assert len(edges.boxes) == 1
+
+
+def test_roi_edge_map_stays_in_region():
+    img, coord = phantom((48, 80, 80), 10, seed=1)
+    edges = snake.EdgeMap(img)
+    result = snake.segment(2, img, coord, ITERATIONS, 1, THRESHOLD, BALLOON, True,
+                           edges=lambda img: edges)
+    box, = edges.boxes
+    assert np.prod([s.stop - s.start for s in box]) < img.size / 2
+    expected = snake.segment(2, img, coord, ITERATIONS, 1, THRESHOLD, BALLOON)
+    np.testing.assert_array_equal(result, expected)
+
+
+@pytest.mark.parametrize('dtype', [np.int16, np.float32])
+def test_recursive_edge_map_is_close(dtype):
+    # Both methods truncate the derivatives of integer images
+    img = phantom((48, 48, 48), 14)[0].astype(dtype)
+    expected = ms.inverse_gaussian_gradient(img, sigma=3.0, dtype=np.float32)
+    result = ms.inverse_gaussian_gradient(img, sigma=3.0, dtype=np.float32,
+                                          method='recursive')
+    assert result.dtype == expected.dtype
+    inner = (slice(13, -13),) * 3
+    assert np.abs(result - expected)[inner].mean() < 0.1
+
+
+@pytest.mark.parametrize('batched', [False, True])
+@pytest.mark.parametrize('workers', [1, 2])
+@pytest.mark.parametrize('roi', [False, True])
+@pytest.mark.parametrize('mode', [1, 3])
+def test_2d_modes_match_dense(volume, mode, roi, workers, batched):
+    img, coord = volume
+    if mode == 1:
+        expected = dense_2d(dense_acwe, img, coord, ITERATIONS, 1)
+    else:
+        expected = dense_2d(dense_gac, snake.edge_map(img)[0], coord, ITERATIONS, 1)
+    result = snake.segment(mode, img, coord, ITERATIONS, 1, THRESHOLD, BALLOON, roi,
+                           workers, batched)
+    np.testing.assert_array_equal(result > 0, expected > 0)
+
+
+@pytest.mark.parametrize('mode', [0, 1, 2, 3])
+def test_growing_roi_matches_dense(mode, monkeypatch):
+    # The object is larger than the first region of interest, which has to
+    # grow for the result to match
+    img, coord = phantom((48, 80, 80), 22, seed=1)
+    grown = []
+    grow_roi_box = snake.grow_roi_box
+
+    def grow(box, margin, shape):
+        grown.append(box)
+        return grow_roi_box(box, margin, shape)
+    monkeypatch.setattr(snake, 'grow_roi_box', grow)
+
+    iterations = 2 * ITERATIONS
+    init_ls = ms.circle_level_set(img.shape, coord[::-1], 5)
+    if mode == 0:
+        expected = dense_acwe(img, init_ls, iterations, 1)
+    elif mode == 1:
+        expected = dense_2d(dense_acwe, img, coord, iterations, 1)
+    elif mode == 2:
+        expected = dense_gac(snake.edge_map(img)[0], init_ls, iterations, 1)
+    else:
+        expected = dense_2d(dense_gac, snake.edge_map(img)[0], coord, iterations, 1)
+    result = snake.segment(mode, img, coord, iterations, 1, THRESHOLD, BALLOON, True)
+    assert grown
+    np.testing.assert_array_equal(result > 0, expected > 0)
+
+
+@pytest.mark.parametrize('adaptive', [False, True])
+def test_propagation_threads(volume, adaptive):
+    img, coord = volume
+    expected = snake.segment(4, img, coord, ITERATIONS, 1, THRESHOLD, BALLOON,
+                             workers=1, adaptive=adaptive)
+    result = snake.segment(4, img, coord, ITERATIONS, 1, THRESHOLD, BALLOON,
+                           workers=2, adaptive=adaptive)
+    np.testing.assert_array_equal(result, expected)
+
+
+def test_seeds_match_single_runs(volume):
+    img, coord = volume
+    other = [coord[0] + 2, coord[1], coord[2]]
+    labels = snake.segment_seeds(2, img, [coord, other], ITERATIONS, 1,
+                                 THRESHOLD, BALLOON, workers=2)
+    first = snake.segment(2, img, coord, ITERATIONS, 1, THRESHOLD, BALLOON) > 0
+    np.testing.assert_array_equal(labels == 1, first)
+
+
+@pytest.mark.parametrize('smoothing', [1, 2])
+@pytest.mark.parametrize('done', [7, 8])
+@pytest.mark.parametrize('mode,roi,batched', [
+    (0, False, False), (0, True, False), (2, False, False), (2, True, False),
+    (1, False, False), (1, False, True), (3, True, False), (3, False, True),
+    (4, False, False),
+])
+def test_resume_matches_full_run(volume, mode, roi, batched, done, smoothing):
+    # An odd number of iterations done leaves the smoothing in the middle of
+    # its alternation, which the resumed run has to continue
+    img, coord = volume
+    iterations = 2 * ITERATIONS
+    expected = snake.segment(mode, img, coord, iterations, smoothing, THRESHOLD,
+                             BALLOON, roi, batched=batched)
+    earlier = snake.segment(mode, img, coord, done, smoothing, THRESHOLD, BALLOON,
+                            roi, batched=batched)
+    result = snake.segment(mode, img, coord, iterations, smoothing, THRESHOLD,
+                           BALLOON, roi, batched=batched, init_level_set=earlier,
+                           done=done)
+    np.testing.assert_array_equal(result > 0, expected > 0)
+
+
+@pytest.mark.parametrize('mode,roi,batched', [
+    (1, False, False), (1, True, True), (3, False, False), (3, False, True),
+    (4, False, False), (4, True, False),
+])
+def test_2d_resume_matches_full_run(growing, mode, roi, batched):
+    # The slices whose seed changed since the earlier result run from scratch
+    img, coord = growing
+    expected = snake.segment(mode, img, coord, 15, 1, THRESHOLD, BALLOON, roi,
+                             batched=batched)
+    earlier = snake.segment(mode, img, coord, 7, 1, THRESHOLD, BALLOON, roi,
+                            batched=batched)
+    result = snake.segment(mode, img, coord, 15, 1, THRESHOLD, BALLOON, roi,
+                           batched=batched, init_level_set=earlier, done=7)
+    np.testing.assert_array_equal(result > 0, expected > 0)
+
+
+@pytest.mark.parametrize('smoothing', [1, 2])
+def test_split_evolution_matches_single_call(smoothing):
+    img, _ = phantom((40, 40), 12)
+    init_ls = ms.circle_level_set(img.shape, None, 4)
+    expected = ms.morphological_chan_vese(img, 9, init_ls, smoothing)
+    first = ms.morphological_chan_vese(img, 5, init_ls, smoothing)
+    result = ms.morphological_chan_vese(img, 4, first, smoothing,
+                                        phase=5 * smoothing)
+    np.testing.assert_array_equal(result, expected)
+
+
+@pytest.mark.parametrize('phantom', ['volume', 'growing'])
+@pytest.mark.parametrize('mode', [0, 1, 2, 3, 4])
+def test_sweep_matches_separate_runs(request, phantom, mode):
+    # The variants with more iterations resume from those with fewer, after
+    # an odd number of them, and with other slices in the 2D modes if the
+    # range plane grows
+    img, coord = request.getfixturevalue(phantom)
+    grid = {'iterations': [7, 15], 'smoothing': [1, 2], 'threshold': [THRESHOLD],
+            'balloon': [BALLOON, -BALLOON]}
+    variants, planes = snake.sweep(mode, img, coord, grid, workers=2)
+    assert len(variants) == 8
+    for i, variant in enumerate(variants):
+        expected = snake.segment(mode, img, coord, variant['iterations'],
+                                 variant['smoothing'], variant['threshold'],
+                                 variant['balloon'])
+        mask = (planes[i // 8] >> (i % 8)) & 1
+        np.testing.assert_array_equal(mask, expected > 0)
+
+
+def dice(a, b):
+    return 2.0 * np.count_nonzero(a & b) / max(np.count_nonzero(a) + np.count_nonzero(b), 1)
+
+
+@pytest.mark.parametrize('radius', [6, 8, 20])
+@pytest.mark.parametrize('mode', [0, 2])
+def test_pyramid_keeps_small_objects(mode, radius):
+    # The coarse levels must not lose, or leak out of, objects smaller than
+    # their seed ball
+    img, coord = phantom((64, 64, 64), radius)
+    grid = np.indices(img.shape)
+    inside = sum((g - 32) ** 2 for g in grid) < radius ** 2
+    full = snake.segment(mode, img, coord, 20, 1, 0.5, BALLOON, True) > 0
+    coarse = snake.segment(mode, img, coord, 20, 1, 0.5, BALLOON, True,
+                           pyramid=True) > 0
+    assert dice(coarse, inside) >= dice(full, inside) - 0.1
@@ -0,0 +1,55 @@
+"""Tests of the messages of the worker:
+
+    python3 -m pytest utils
+"""
+import numpy as np
+import pytest
+
+import snake
+import test_snake
+import worker
+
+
+def replay(shape, messages):
+    """Mask the 'live' `messages` give when applied in order."""
+    mask = np.zeros(shape, dtype=np.uint8).ravel()
+    for message in messages:
+        mask[message['added']] = 1
+        mask[message['removed']] = 0
+    return mask.reshape(shape)
+
+
+@pytest.mark.parametrize('mode,roi', [(0, False), (0, True), (1, False), (3, True)])
+def test_live_mask_follows_the_snake(mode, roi):
+    img, coord = test_snake.phantom((24, 32, 32), 9)
+    messages = []
+    live = worker.LiveMask(img.shape, messages.append, 0.0)
+    expected = np.zeros(img.shape, dtype=np.uint8)
+
+    def update(index, ls):
+        expected[index] = ls
+        live.update(index, ls)
+    snake.segment(mode, img, coord, test_snake.ITERATIONS, 1,
+                  test_snake.THRESHOLD, test_snake.BALLOON, roi, workers=2,
+                  live=update)
+    live.flush()
+    assert len(messages) > 1
+    np.testing.assert_array_equal(replay(img.shape, messages), expected)
+
+
+def test_live_mask_copies_when_sending():
+    # An update only keeps a reference to the level set until the next
+    # message, which shows it as it is then
+    messages = []
+    live = worker.LiveMask((4, 4), messages.append, 3600.0)
+    box = (slice(1, 3), slice(0, 4))
+    ls = np.zeros((2, 4), dtype=np.int8)
+    live.update(box, ls)
+    assert not live.current.any()
+    ls[0, 1] = 1
+    live.update(box, ls)
+    ls[1, 2] = 1
+    live.flush()
+    expected = np.zeros((4, 4), dtype=np.uint8)
+    expected[1, 1] = expected[2, 2] = 1
+    np.testing.assert_array_equal(replay((4, 4), messages), expected)
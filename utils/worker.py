@@ -0,0 +1,339 @@
+"""Long-lived segmentation worker.
+
+Started by the selector module with the python3 interpreter that has numpy and
+scipy, so the libraries are imported once and every segmentation only pays for
+its own computation. It listens on a local socket, prints the port on the first
+line of its standard output and serves a single connection. Requests and
+replies are dictionaries:
+
+    {'command': 'ping'}
+        -> {'status': 'ok', 'pid': ...}
+    {'command': 'segment', 'mode': ..., 'iterations': ..., 'smoothing': ...,
+     'threshold': ..., 'balloon': ..., 'roi': ..., 'coord': [i, j, k],
+     'image': path, 'out': path, 'workers': n, 'batched': ...,
+     'pyramid': ..., 'preview': ..., 'volume': key, 'progress': ...,
+     'live': milliseconds, 'adaptive': ..., 'init': path, 'done': n}
+        -> {'status': 'progress', 'fraction': f}, ...
+        -> {'status': 'live', 'added': indices, 'removed': indices}, ...
+        -> {'status': 'preview', 'mask': path}, ...
+        -> {'status': 'done', 'time': seconds, 'log': output of the run}
+    {'command': 'segment', ... without 'out' ...}
+        -> {'status': 'done', 'time': seconds, 'result': {'shape': ...,
+            'box': [[start, stop], ...], 'packed': ..., 'data': bytes}, ...}
+    {'command': 'segment', ..., 'coords': [[i, j, k], ...], ...}
+        -> {'status': 'done', 'time': seconds, 'counts': [n, ...], 'log': ...}
+    {'command': 'sweep', 'mode': ..., 'grid': {'iterations': [...],
+     'smoothing': [...], 'threshold': [...], 'balloon': [...]},
+     'coord': [i, j, k], 'image': path, 'out': path, ...}
+        -> {'status': 'progress', 'fraction': f}, ...
+        -> {'status': 'done', 'time': seconds, 'variants': [{...}, ...],
+            'counts': [n, ...], 'log': ...}
+
+`image` and `out` are .npy files created by the caller, usually in /dev/shm.
+They are memory mapped: the volume is read from the caller's buffer and the
+mask is written in place into `out`, which must already have the shape of the
+volume. Without `out`, the reply carries the mask instead, as the `result` of
+`snake.compact_mask`: the box around the object and its voxels, bit-packed, so
+a small object costs little whatever the size of the volume. `workers` is
+optional and sets the number of threads segmenting the slices of the 2D modes;
+`batched`, also optional, evolves those slices together as one stack instead.
+`pyramid` runs the 3D modes from coarse to fine resolution and, if `preview` is
+set, every coarse result is saved as a mask next to `image` and announced with
+a 'preview' message before the reply. `adaptive`, also optional, adapts the
+iterations of every slice of acwe2d_prev to the change of the previous one.
+`volume` identifies the contents of the volume, e.g. by the id and the
+modification time of its node; when given, the edge map of GAC, or the parts of
+it computed for the regions of interest, is kept for the next requests on the
+same volume. If `progress` is set, the estimated fraction of the segmentation
+that is done is sent in 'progress' messages, at most every PROGRESS_INTERVAL
+seconds. If `live` is set, the mask is streamed while the snake evolves, at
+most every `live` milliseconds, as the flat indices into the volume of the
+voxels that entered and left it since the previous 'live' message; the mask
+starts empty. `init`, a .npy file like `out`, holds a level set to start from
+instead of a ball around the seed, e.g. an earlier result, which already ran
+`done` of the iterations.
+
+With `coords` instead of `coord`, the object around every seed is segmented in
+the same run and `out` receives a label volume, where the object of the n-th
+seed is labelled n + 1, and `init` is such a label volume too. `counts` are the
+number of voxels of every label. Those runs send no previews nor live masks.
+
+A sweep segments the object around `coord` once for every combination of the
+values of `grid`, listed in `variants`, and accepts the other options of
+'segment' but `preview`, `live`, `init` and `done`. The masks are written as
+bits into `out`, or `result`, of shape (ceil(len(variants) / 8),) + the shape
+of the volume and type uint8: the mask of the n-th variant is bit n % 8 of
+`out[n // 8]`. `counts` are the number of voxels of every mask.
+
+Failed requests are answered with {'status': 'error', 'message': traceback}.
+The worker exits when the connection is closed; the caller cancels a request
+by killing the worker.
+"""
+import contextlib
+import io
+import os
+import sys
+import threading
+import time
+import traceback
+from multiprocessing.connection import Listener
+
+import numpy as np
+
+import snake
+
+
+edge_cache = snake.EdgeCache()
+
+# Minimum delay in seconds between two progress messages
+PROGRESS_INTERVAL = 0.2
+
+
+def index_box(index, shape):
+    """Box of slices, one per axis, covering the part `index` of an array of
+    `shape`. `index` is Ellipsis or a tuple of slices, integers and lists of
+    integers, as passed to the `live` callback of `snake.segment`."""
+    if index is Ellipsis:
+        index = ()
+    box = []
+    for i, n in zip(index, shape):
+        if isinstance(i, slice):
+            start, stop, _ = i.indices(n)
+        else:
+            i = np.asarray(i)
+            start, stop = int(i.min()), int(i.max()) + 1
+        box.append(slice(start, stop))
+    return tuple(box) + tuple(slice(0, n) for n in shape[len(box):])
+
+
+class LiveMask(object):
+
+    def __init__(self, shape, notify, interval):
+        """Mask of a segmentation while it runs, sent with `notify` as the
+        voxels that changed since the previous message, at most every
+        `interval` seconds.
+
+        Only the box around the parts updated since the previous message is
+        compared, so the messages of a snake evolving in a region of interest
+        cost the size of the region, not of the volume. A level set is only
+        copied into the mask once a message is due or another part is updated,
+        so a snake updating its region after every iteration costs a reference
+        in between, and the message shows the level set as it is then.
+        """
+        self.current = np.zeros(shape, dtype=np.uint8)
+        self.sent = np.zeros(shape, dtype=np.uint8)
+        self.notify = notify
+        self.interval = interval
+        self.pending = None
+        self.dirty = None
+        self.last = 0.0
+        self.lock = threading.Lock()
+        # 32 bit indices halve the messages of all but huge volumes
+        self.index_dtype = np.uint32 if self.current.size < 2 ** 32 else np.int64
+
+    def update(self, index, ls):
+        """Set the part `index` of the mask to the level set `ls`."""
+        with self.lock:
+            # The snakes pass the same index, and level set, after every
+            # iteration on a region
+            if self.pending is not None and self.pending[0] is not index:
+                self.apply()
+            self.pending = (index, ls)
+            if time.time() - self.last >= self.interval:
+                self.flush()
+
+    def apply(self):
+        """Copy the pending level set into the mask."""
+        (index, ls), self.pending = self.pending, None
+        self.current[index] = ls
+        box = index_box(index, self.current.shape)
+        if self.dirty is not None:
+            box = tuple(slice(min(a.start, b.start), max(a.stop, b.stop))
+                        for a, b in zip(self.dirty, box))
+        self.dirty = box
+
+    def flush(self):
+        if self.pending is not None:
+            self.apply()
+        box, self.dirty = self.dirty, None
+        self.last = time.time()
+        if box is None:
+            return
+        position = np.nonzero(self.current[box] != self.sent[box])
+        if len(position[0]) == 0:
+            return
+        values = self.current[box][position]
+        self.sent[box][position] = values
+        changed = np.ravel_multi_index(
+            [p + s.start for p, s in zip(position, box)],
+            self.current.shape).astype(self.index_dtype)
+        self.notify({'status': 'live', 'added': changed[values > 0],
+                     'removed': changed[values == 0]})
+
+
+def ping(message, notify):
+    return {'status': 'ok', 'pid': os.getpid()}
+
+
+def progress_callback(message, notify):
+    """Callback sending the progress of a request, if it asks for it."""
+    if not message.get('progress'):
+        return None
+    sent = [0.0]
+
+    def progress(fraction):
+        now = time.time()
+        if fraction < 1.0 and now - sent[0] < PROGRESS_INTERVAL:
+            return
+        sent[0] = now
+        notify({'status': 'progress', 'fraction': fraction})
+    return progress
+
+
+def edge_function(message):
+    """Edge map of GAC for a request, cached if it identifies its volume."""
+    if message.get('volume') is None:
+        return snake.EdgeMap
+
+    def edges(img):
+        return edge_cache.get(message['volume'], img)
+    return edges
+
+
+def write_result(message, ls, reply):
+    """Write the result `ls` into the `out` file of the request, or into
+    the reply in compact form if it has none."""
+    if not message.get('out'):
+        reply['result'] = snake.compact_mask(ls)
+        return
+    out = np.load(message['out'], mmap_mode='r+')
+    out[...] = ls
+    out.flush()
+    del out
+
+
+def segment(message, notify):
+    img = np.load(message['image'], mmap_mode='r')
+
+    preview = None
+    if message.get('preview'):
+        previews = []
+
+        def preview(ls):
+            path = os.path.join(os.path.dirname(message['image']),
+                                'preview-%d.npy' % len(previews))
+            np.save(path, ls.astype(np.uint8))
+            previews.append(path)
+            notify({'status': 'preview', 'mask': path})
+
+    progress = progress_callback(message, notify)
+
+    live = None
+    if message.get('live') and 'coord' in message:
+        live = LiveMask(img.shape, notify, message['live'] / 1000.0).update
+
+    edges = edge_function(message)
+
+    init = None
+    if message.get('init'):
+        init = np.load(message['init'], mmap_mode='r')
+
+    start = time.time()
+    reply = {'status': 'done'}
+    if 'coords' in message:
+        ls = snake.segment_seeds(message['mode'], img, message['coords'],
+                                 message['iterations'], message['smoothing'],
+                                 message['threshold'], message['balloon'],
+                                 message.get('roi', False),
+                                 message.get('workers', snake.WORKERS),
+                                 message.get('batched', False),
+                                 message.get('pyramid', False), edges,
+                                 progress, message.get('adaptive', False),
+                                 init, message.get('done', 0))
+        counts = np.bincount(ls.ravel(), minlength=len(message['coords']) + 1)
+        reply['counts'] = counts[1:].tolist()
+    else:
+        ls = snake.segment(message['mode'], img, message['coord'],
+                           message['iterations'], message['smoothing'],
+                           message['threshold'], message['balloon'],
+                           message.get('roi', False),
+                           message.get('workers', snake.WORKERS),
+                           message.get('batched', False),
+                           message.get('pyramid', False), preview, edges,
+                           progress, live, message.get('adaptive', False),
+                           init, message.get('done', 0))
+    elapsed = time.time() - start
+    print("Time: " + str(elapsed) + " sec.")
+
+    write_result(message, ls, reply)
+    reply['time'] = elapsed
+    return reply
+
+
+def sweep(message, notify):
+    img = np.load(message['image'], mmap_mode='r')
+
+    start = time.time()
+    variants, planes = snake.sweep(message['mode'], img, message['coord'],
+                                   message['grid'], message.get('roi', False),
+                                   message.get('workers', snake.WORKERS),
+                                   message.get('batched', False),
+                                   message.get('pyramid', False),
+                                   edge_function(message),
+                                   progress_callback(message, notify),
+                                   message.get('adaptive', False))
+    elapsed = time.time() - start
+    print("Time: " + str(elapsed) + " sec.")
+
+    counts = [int(np.count_nonzero((planes[i // 8] >> (i % 8)) & 1))
+              for i in range(len(variants))]
+    reply = {'status': 'done', 'time': elapsed, 'variants': variants,
+             'counts': counts}
+    write_result(message, planes, reply)
+    return reply
+
+
+COMMANDS = {
+    'ping': ping,
+    'segment': segment,
+    'sweep': sweep,
+}
+
+
+def handle(message, notify):
+    log = io.StringIO()
+    try:
+        with contextlib.redirect_stdout(log):
+            reply = COMMANDS[message['command']](message, notify)
+    except Exception:
+        reply = {'status': 'error', 'message': traceback.format_exc()}
+    reply['log'] = log.getvalue()
+    return reply
+
+
+def serve(authkey):
+    listener = Listener(('localhost', 0), authkey=authkey)
+    print(listener.address[1])
+    sys.stdout.flush()
+
+    connection = listener.accept()
+    listener.close()
+
+    # The threads of the 2D modes report their progress concurrently
+    lock = threading.Lock()
+
+    def notify(reply):
+        with lock:
+            connection.send(reply)
+
+    while True:
+        try:
+            message = connection.recv()
+        except EOFError:
+            break
+        notify(handle(message, notify))
+    connection.close()
+
+
+if __name__ == '__main__':
+    serve(os.environ['SELECTOR_WORKER_AUTHKEY'].encode())